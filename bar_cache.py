@@ -0,0 +1,189 @@
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+from logger import Logger
+import logging
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from date_intervals import merge_intervals, missing_intervals, to_date
+
+
+class BarCache:
+    def __init__(self, cache_dir, market_timezone=None, compact_min_parts=8, row_group_size=100000):
+        """
+        Initializes the BarCache class, a persistent local cache of Polygon bars.
+
+        Bars are cached per (ticker, multiplier, time_frame, adjusted) key in a directory holding
+        append-only parquet part files and a metadata file with the date intervals already fetched.
+        Overlapping intervals are merged, so a rerun only needs to request the gaps from the API.
+
+        Once a key holds `compact_min_parts` part files they are merged into one part sorted by `t`, with
+        row groups of `row_group_size` bars. Reads push the requested range down to parquet as a filter on
+        `t`, so only the parts and row groups overlapping the range are read and a read costs the size of
+        the range and not the size of the cached history.
+
+        Args:
+            cache_dir (str): Root directory of the cache, created if it does not exist.
+            market_timezone (str, optional): The timezone of the exchange the requested dates are trading days
+                                             of. Defaults to the `market_timezone` environment variable, or
+                                             "America/New_York".
+            compact_min_parts (int): Number of part files of a key from which they are compacted into one.
+            row_group_size (int): Number of bars per row group of the compacted parts.
+
+        Example:
+            bar_cache = BarCache(cache_dir="cache/bars")
+            key = bar_cache.make_key(ticker="AAPL", multiplier="1", time_frame="day", adjusted="true")
+            gaps = bar_cache.missing_intervals(key, "2024-01-01", "2024-12-31")
+        """
+        self.log = Logger(name=__name__, log_file="logs/app.log", level=logging.DEBUG).get_logger()
+        self.cache_dir = cache_dir
+        self.market_timezone = market_timezone or os.getenv('market_timezone', 'America/New_York')
+        self.compact_min_parts = max(2, int(compact_min_parts))
+        self.row_group_size = int(row_group_size)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(ticker, multiplier, time_frame, adjusted):
+        return f"{ticker}_{multiplier}_{time_frame}_{str(adjusted).lower()}".replace(os.sep, '-').replace(':', '-')
+
+    def _lock(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _key_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _metadata_path(self, key):
+        return os.path.join(self._key_dir(key), 'intervals.json')
+
+    def _read_intervals(self, key):
+        if not os.path.exists(self._metadata_path(key)):
+            return []
+        with open(self._metadata_path(key)) as metadata_file:
+            return [(to_date(start), to_date(end)) for start, end in json.load(metadata_file)['intervals']]
+
+    def _write_intervals(self, key, intervals):
+        tmp_path = self._metadata_path(key) + '.tmp'
+        with open(tmp_path, 'w') as metadata_file:
+            json.dump({'intervals': [[str(start), str(end)] for start, end in intervals]}, metadata_file)
+        os.replace(tmp_path, self._metadata_path(key))
+
+    def _part_paths(self, key):
+        if not os.path.isdir(self._key_dir(key)):
+            return []
+        return sorted(os.path.join(self._key_dir(key), name) for name in os.listdir(self._key_dir(key))
+                      if name.endswith('.parquet'))
+
+    @staticmethod
+    def _part_number(path):
+        return int(os.path.basename(path)[len('part-'):-len('.parquet')])
+
+    def _next_part_path(self, key):
+        part_paths = self._part_paths(key)
+        part_number = self._part_number(part_paths[-1]) + 1 if part_paths else 0
+        return os.path.join(self._key_dir(key), f'part-{part_number:06d}.parquet')
+
+    def _day_bounds(self, date_to_fetch_from, date_to_fetch_till):
+        """
+        Returns the epoch milliseconds [start, end) of the trading days from `date_to_fetch_from` to
+        `date_to_fetch_till`, from the local midnight of the first day to the local midnight after the last.
+        """
+        start = pd.Timestamp(to_date(date_to_fetch_from)).tz_localize(self.market_timezone, nonexistent='shift_forward')
+        end = pd.Timestamp(to_date(date_to_fetch_till) + timedelta(days=1)).tz_localize(self.market_timezone,
+                                                                                         nonexistent='shift_forward')
+        return start.value // 10 ** 6, end.value // 10 ** 6
+
+    def _read_parts(self, part_paths, filters=None):
+        parts = [pq.read_table(path, filters=filters).to_pandas() for path in part_paths]
+        parts = [part for part in parts if not part.empty]
+        if not parts:
+            return None
+        # later parts hold the latest fetch of a bar
+        return pd.concat(parts, ignore_index=True).drop_duplicates(subset='t', keep='last').sort_values(
+            't', ignore_index=True)
+
+    def _compact(self, key):
+        """
+        Merges the part files of a key into one part sorted by `t`. The merged part replaces the first part
+        before the others are removed, so an interrupted compaction only leaves duplicates behind.
+        """
+        part_paths = self._part_paths(key)
+        bars = self._read_parts(part_paths)
+        if bars is None:
+            return
+        tmp_path = os.path.join(self._key_dir(key), 'compacted.tmp')
+        pq.write_table(pa.Table.from_pandas(bars, preserve_index=False), tmp_path, row_group_size=self.row_group_size)
+        os.replace(tmp_path, part_paths[0])
+        for path in part_paths[1:]:
+            os.remove(path)
+        self.log.debug(f"compacted {len(part_paths)} parts of {key} into one part of {len(bars)} bars")
+
+    def missing_intervals(self, key, date_to_fetch_from, date_to_fetch_till):
+        """
+        Returns the date intervals of the requested range which are not cached yet.
+
+        Args:
+            key (str): The cache key, see `make_key`.
+            date_to_fetch_from (str): The start date of the requested range (format: YYYY-MM-DD).
+            date_to_fetch_till (str): The end date of the requested range (format: YYYY-MM-DD).
+
+        Returns:
+            List[Tuple[date, date]]: The gaps to fetch from the API, empty if the range is fully cached.
+        """
+        with self._lock(key):
+            return missing_intervals((to_date(date_to_fetch_from), to_date(date_to_fetch_till)),
+                                     self._read_intervals(key))
+
+    def store(self, key, bars, date_to_fetch_from, date_to_fetch_till):
+        """
+        Stores freshly fetched bars of a date range in the cache.
+
+        The bars are written as a new part file and the range is recorded as fetched, except for
+        today, which is never marked as complete because more bars may still arrive for it. The parts of
+        the key are compacted once there are `compact_min_parts` of them.
+
+        Args:
+            key (str): The cache key, see `make_key`.
+            bars (pd.DataFrame): The bars fetched for the range, may be None or empty.
+            date_to_fetch_from (str): The start date of the fetched range (format: YYYY-MM-DD).
+            date_to_fetch_till (str): The end date of the fetched range (format: YYYY-MM-DD).
+        """
+        start = to_date(date_to_fetch_from)
+        end = min(to_date(date_to_fetch_till), datetime.now().date() - timedelta(days=1))
+
+        with self._lock(key):
+            os.makedirs(self._key_dir(key), exist_ok=True)
+            if bars is not None and not bars.empty:
+                bars.sort_values('t').to_parquet(self._next_part_path(key), index=False)
+            if start <= end:
+                self._write_intervals(key, merge_intervals(self._read_intervals(key) + [(start, end)]))
+            if len(self._part_paths(key)) >= self.compact_min_parts:
+                self._compact(key)
+
+        self.log.debug(f"cached bars of {key} between {date_to_fetch_from} and {date_to_fetch_till}")
+
+    def load(self, key, date_to_fetch_from, date_to_fetch_till):
+        """
+        Loads the cached bars of a range of trading days.
+
+        The range is pushed down to parquet as a filter on the epoch `t` column between the local midnights
+        of the market timezone which bound it, so the post-market bars of the last day are kept and the part
+        files and row groups outside of the range are skipped with their statistics.
+
+        Args:
+            key (str): The cache key, see `make_key`.
+            date_to_fetch_from (str): The start date of the range (format: YYYY-MM-DD).
+            date_to_fetch_till (str): The end date of the range (format: YYYY-MM-DD).
+
+        Returns:
+            pd.DataFrame: The cached bars of the range sorted by their epoch `t` column, None if nothing is cached.
+        """
+        start, end = self._day_bounds(date_to_fetch_from, date_to_fetch_till)
+        with self._lock(key):
+            return self._read_parts(self._part_paths(key), filters=[('t', '>=', start), ('t', '<', end)])
@@ -0,0 +1,159 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from logger import Logger
+import logging
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from frankfurter_api_handler import FrankfurterApiHandler
+from polygon_api_handler import PolygonApiHandler
+from request_scheduler import RequestScheduler
+
+
+class BatchFetcher:
+    def __init__(self, tickers, date_to_fetch_from, date_to_fetch_till, number_of_time_frames, time_frame, adjusted,
+                 sort, api_key, date_column_name, latest, base_currency, max_workers=8, bar_cache=None,
+                 rate_store=None, request_scheduler=None):
+        """
+        Initializes the BatchFetcher class with parameters necessary for fetching stock prices
+        of many tickers from the Polygon API together with the exchange rates from the Frankfurter API.
+
+        All requests are executed on a bounded thread pool and sent through one RequestScheduler,
+        so keep-alive connections are reused between tickers and the API rate limits are respected. The Frankfurter request runs
+        alongside the Polygon requests instead of before them.
+
+        Args:
+            tickers (List[str]): The stock ticker symbols to fetch data for.
+            date_to_fetch_from (str): The start date for the data to fetch (format: YYYY-MM-DD).
+            date_to_fetch_till (str): The end date for the data to fetch (format: YYYY-MM-DD).
+            number_of_time_frames (str): The number of time frames to fetch in string.
+            time_frame (str): The time frame for the data (e.g., "day", "minute").
+            adjusted (bool): Whether to fetch adjusted data (True or False).
+            sort (str): Sorting order for the data ("asc" for ascending or "desc" for descending).
+            api_key (str): The API key for authenticating with the Polygon API.
+            date_column_name (str): The name of the date column in the resulting DataFrames.
+            latest (bool): If True, fetch the latest data; if False, fetch historical data.
+            base_currency (str): The base currency for the exchange rate data (e.g., "USD").
+            max_workers (int): Maximum number of requests executed concurrently.
+            bar_cache (BarCache, optional): Local cache of bars shared by all tickers.
+            rate_store (FxRateStore, optional): Store of exchange rates shared by all tickers and batches.
+            request_scheduler (RequestScheduler, optional): Scheduler of all requests, a new one with a connection
+                                                            pool of `max_workers` connections is created if not given.
+
+        Example:
+            batch_fetcher = BatchFetcher(tickers=["AAPL", "MSFT"],
+                                         date_to_fetch_from="2024-01-01",
+                                         date_to_fetch_till="2024-12-31",
+                                         number_of_time_frames='1',
+                                         time_frame="day",
+                                         adjusted=True,
+                                         sort="asc",
+                                         api_key="your_api_key",
+                                         date_column_name="date",
+                                         latest=False,
+                                         base_currency="USD")
+            currency_data, stock_price_data, errors = batch_fetcher.fetch()
+        """
+        self.log = Logger(name=__name__, log_file="logs/app.log", level=logging.DEBUG).get_logger()
+        self.tickers = list(dict.fromkeys(tickers))
+        self.date_to_fetch_from = date_to_fetch_from
+        self.date_to_fetch_till = date_to_fetch_till
+        self.number_of_time_frames = number_of_time_frames
+        self.time_frame = time_frame
+        self.adjusted = adjusted
+        self.sort = sort
+        self.api_key = api_key
+        self.date_column_name = date_column_name
+        self.latest = latest
+        self.base_currency = base_currency
+        self.max_workers = max(1, int(max_workers))
+        self.bar_cache = bar_cache
+        self.rate_store = rate_store
+        self.request_scheduler = request_scheduler if request_scheduler is not None \
+            else RequestScheduler(pool_size=self.max_workers + 1)
+
+    def _create_polygon_handler(self, ticker):
+        return PolygonApiHandler(ticker=ticker,
+                                 date_to_fetch_from=self.date_to_fetch_from,
+                                 date_to_fetch_till=self.date_to_fetch_till,
+                                 number_of_time_frames=self.number_of_time_frames,
+                                 time_frame=self.time_frame,
+                                 adjusted=self.adjusted,
+                                 sort=self.sort,
+                                 api_key=self.api_key,
+                                 date_column_name=self.date_column_name,
+                                 latest=self.latest,
+                                 request_scheduler=self.request_scheduler,
+                                 bar_cache=self.bar_cache)
+
+    def _create_frankfurter_handler(self):
+        return FrankfurterApiHandler(ticker=",".join(self.tickers),
+                                     date_to_fetch_from=self.date_to_fetch_from,
+                                     date_to_fetch_till=self.date_to_fetch_till,
+                                     base_currency=self.base_currency,
+                                     date_column_name=self.date_column_name,
+                                     latest=self.latest,
+                                     request_scheduler=self.request_scheduler,
+                                     rate_store=self.rate_store)
+
+    def fetch(self):
+        """
+        Fetches the exchange rates and the stock prices of all tickers concurrently.
+
+        A failure of one ticker does not abort the run, the error is logged and reported
+        back to the caller in the errors dictionary instead.
+
+        Returns:
+            pd.DataFrame: The exchange rate data, None if the Frankfurter request failed.
+            Dict[str, pd.DataFrame]: The stock price data per ticker, for every ticker fetched successfully.
+            Dict[str, str]: The error message per ticker, for every ticker that failed.
+        """
+        currency_data = None
+        stock_price_data = {}
+        errors = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers + 1) as executor:
+            currency_future = executor.submit(self._create_frankfurter_handler().get_frankfurter_data)
+            ticker_futures = {executor.submit(self._create_polygon_handler(ticker).get_polygon_data): ticker
+                              for ticker in self.tickers}
+
+            for future in as_completed(ticker_futures):
+                ticker = ticker_futures[future]
+                try:
+                    stock_price_data[ticker] = future.result()
+                except Exception as e:
+                    errors[ticker] = str(e)
+                    self.log.error(f"failed to fetch data for ticker {ticker}: {e}")
+
+            try:
+                currency_data = currency_future.result()
+            except Exception as e:
+                self.log.error(f"failed to fetch currency data for base currency {self.base_currency}: {e}")
+
+        self.log.info(f"fetched {len(stock_price_data)} of {len(self.tickers)} tickers, {len(errors)} failed")
+        return currency_data, stock_price_data, errors
+
+    @staticmethod
+    def combine_frames(stock_price_data):
+        """
+        Combines the per ticker DataFrames returned by `fetch` into one DataFrame.
+
+        Categorical columns (e.g. `ticker`, `currency`) hold different categories in every DataFrame,
+        so their categories are unified first to keep them categorical in the combined DataFrame.
+
+        Args:
+            stock_price_data (Dict[str, pd.DataFrame]): The stock price data per ticker.
+
+        Returns:
+            pd.DataFrame: All the stock price data in one DataFrame, None if there is no data.
+        """
+        frames = [frame for frame in stock_price_data.values() if frame is not None]
+        if not frames:
+            return None
+
+        for column in frames[0].columns:
+            if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+                categories = union_categoricals([frame[column] for frame in frames if column in frame.columns]).categories
+                frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)})
+                          if column in frame.columns else frame for frame in frames]
+        return pd.concat(frames, ignore_index=True)
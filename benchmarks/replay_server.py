@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CURRENCIES = ['AUD', 'CAD', 'CHF', 'EUR', 'GBP', 'ILS', 'JPY']
+BAR_MILLISECONDS = {'second': 1000, 'minute': 60 * 1000, 'hour': 60 * 60 * 1000, 'day': 24 * 60 * 60 * 1000}
+
+
+def synthetic_bars(ticker, number_of_bars, start_date, bar_milliseconds, missing_n_rate=0.001):
+    """
+    Generates deterministic random walk bars of a ticker in the Polygon aggregates format,
+    a fraction `missing_n_rate` of the bars has no `n` field.
+    """
+    rng = random.Random(zlib.crc32(ticker.encode()))
+    start_ms = int(datetime.combine(start_date, datetime.min.time()).timestamp() * 1000)
+    price = rng.uniform(10, 500)
+    bars = []
+    for bar_index in range(number_of_bars):
+        open_price = price
+        price = max(0.01, price * (1 + rng.gauss(0, 0.002)))
+        high_price = max(open_price, price) * (1 + rng.random() * 0.001)
+        low_price = min(open_price, price) * (1 - rng.random() * 0.001)
+        bar = {'v': float(rng.randint(100, 100000)), 'vw': round((open_price + price) / 2, 4),
+               'o': round(open_price, 4), 'c': round(price, 4), 'h': round(high_price, 4),
+               'l': round(low_price, 4), 't': start_ms + bar_index * bar_milliseconds}
+        # Polygon leaves out the number of transactions on some bars
+        if rng.random() >= missing_n_rate:
+            bar['n'] = rng.randint(1, 500)
+        bars.append(bar)
+    return bars
+
+
+def synthetic_rates(base_currency, date_to_fetch_from, date_to_fetch_till):
+    """
+    Generates deterministic exchange rates of the business days of a date range in the Frankfurter format.
+    """
+    rates = {}
+    day = date_to_fetch_from
+    while day <= date_to_fetch_till:
+        if day.weekday() < 5:
+            rng = random.Random(zlib.crc32(f'{base_currency}{day}'.encode()))
+            rates[str(day)] = {currency: round(rng.uniform(0.5, 150), 4) for currency in CURRENCIES
+                               if currency != base_currency}
+        day += timedelta(days=1)
+    return rates
+
+
+class ReplayServer:
+    def __init__(self, bars_per_ticker=10000, page_size=5000, latency_ms=0, error_rate=0.0, recordings_dir=None,
+                 host='127.0.0.1', port=0):
+        """
+        Initializes the ReplayServer class, a local stand in of the Polygon and Frankfurter APIs used by
+        the benchmarks, so the pipeline can be measured without hitting the live endpoints.
+
+        Polygon aggregates are served in pages of `page_size` bars linked by `next_url`, Frankfurter rates are
+        served for every business day of the requested range. Payloads are synthetic unless a recording exists
+        in `recordings_dir`: `<ticker>.json` holding a list of Polygon bars, `rates_<base currency>.json`
+        holding a Frankfurter `rates` object. Every response waits `latency_ms` milliseconds and fails with
+        status 503 with probability `error_rate`.
+
+        Args:
+            bars_per_ticker (int): Number of synthetic bars served per ticker.
+            page_size (int): Maximum number of bars per Polygon page.
+            latency_ms (float): Latency injected in every response.
+            error_rate (float): Probability of a response failing with status 503.
+            recordings_dir (str, optional): Directory of recorded payloads served instead of synthetic ones.
+            host (str): The host to listen on.
+            port (int): The port to listen on, a free port is picked if 0.
+
+        Example:
+            with ReplayServer(bars_per_ticker=100000, page_size=50000) as replay_server:
+                os.environ['polygon_base_url'] = replay_server.url
+        """
+        self.bars_per_ticker = bars_per_ticker
+        self.page_size = page_size
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.recordings_dir = recordings_dir
+        self._bars = {}
+        self._pages = {}
+        self._bars_lock = threading.Lock()
+        self._random = random.Random(0)
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.url = f'http://{host}:{self.server.server_address[1]}'
+        self._thread = None
+
+    def _recording(self, name):
+        if not self.recordings_dir:
+            return None
+        path = os.path.join(self.recordings_dir, f'{name}.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as recording_file:
+            return json.load(recording_file)
+
+    def _get_bars(self, ticker, time_frame, date_to_fetch_from):
+        with self._bars_lock:
+            if ticker not in self._bars:
+                recorded_bars = self._recording(ticker)
+                self._bars[ticker] = recorded_bars if recorded_bars is not None else \
+                    synthetic_bars(ticker, self.bars_per_ticker, date_to_fetch_from,
+                                   BAR_MILLISECONDS.get(time_frame, BAR_MILLISECONDS['minute']))
+            return self._bars[ticker]
+
+    def polygon_payload(self, path, query):
+        # /{version}/aggs/ticker/{ticker}/range/{multiplier}/{time_frame}/{from}/{to}
+        parts = path.strip('/').split('/')
+        ticker, time_frame, date_to_fetch_from = parts[3], parts[6], parts[7]
+        # `from` is a date or epoch milliseconds
+        start_date = datetime.utcfromtimestamp(int(date_to_fetch_from) / 1000).date() if date_to_fetch_from.isdigit() \
+            else datetime.strptime(date_to_fetch_from, '%Y-%m-%d').date()
+        bars = self._get_bars(ticker, time_frame, start_date)
+        page_size = min(self.page_size, int(query.get('limit', [self.page_size])[0]))
+        cursor = int(query.get('cursor', [0])[0])
+        page = bars[cursor:cursor + page_size]
+        payload = {'ticker': ticker, 'status': 'OK', 'resultsCount': len(page), 'results': page}
+        if cursor + page_size < len(bars):
+            payload['next_url'] = f'{self.url}{path}?cursor={cursor + page_size}&limit={page_size}'
+        return payload
+
+    def frankfurter_payload(self, path, query):
+        base_currency = query.get('base', ['USD'])[0]
+        recorded_rates = self._recording(f'rates_{base_currency}')
+        if path.endswith('/latest'):
+            rates = recorded_rates or synthetic_rates(base_currency, date.today() - timedelta(days=7), date.today())
+            latest_date = max(rates)
+            return {'amount': 1.0, 'base': base_currency, 'date': latest_date, 'rates': rates[latest_date]}
+        date_to_fetch_from, date_to_fetch_till = path.strip('/').split('/')[-1].split('..')
+        rates = recorded_rates or synthetic_rates(base_currency,
+                                                  datetime.strptime(date_to_fetch_from, '%Y-%m-%d').date(),
+                                                  datetime.strptime(date_to_fetch_till, '%Y-%m-%d').date())
+        return {'amount': 1.0, 'base': base_currency, 'start_date': date_to_fetch_from,
+                'end_date': date_to_fetch_till, 'rates': rates}
+
+    def _handler_class(self):
+        replay_server = self
+
+        class ReplayRequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if replay_server.latency_ms:
+                    time.sleep(replay_server.latency_ms / 1000)
+                if replay_server.error_rate and replay_server._random.random() < replay_server.error_rate:
+                    self._send(503, {'status': 'ERROR', 'error': 'injected error'})
+                    return
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                query.pop('apiKey', None)
+                if '/aggs/ticker/' in url.path:
+                    # pages are encoded once, so repeated runs measure the client and not the server
+                    page_key = (url.path, tuple(sorted((key, tuple(value)) for key, value in query.items())))
+                    if page_key not in replay_server._pages:
+                        replay_server._pages[page_key] = json.dumps(replay_server.polygon_payload(url.path, query)).encode()
+                    self._send_body(200, replay_server._pages[page_key])
+                else:
+                    self._send(200, replay_server.frankfurter_payload(url.path, query))
+
+            def _send(self, status_code, payload):
+                self._send_body(status_code, json.dumps(payload).encode())
+
+            def _send_body(self, status_code, body):
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return ReplayRequestHandler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand in of the Polygon and Frankfurter APIs')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--bars-per-ticker', type=int, default=10000)
+    parser.add_argument('--page-size', type=int, default=5000)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--recordings-dir', default=None)
+    args = parser.parse_args()
+    replay_server = ReplayServer(bars_per_ticker=args.bars_per_ticker, page_size=args.page_size,
+                                 latency_ms=args.latency_ms, error_rate=args.error_rate,
+                                 recordings_dir=args.recordings_dir, port=args.port)
+    print(f'serving on {replay_server.url}')
+    replay_server.server.serve_forever()
@@ -0,0 +1,220 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.replay_server import ReplayServer
+
+
+def _serve(replay_server_kwargs, url_queue):
+    replay_server = ReplayServer(**replay_server_kwargs)
+    url_queue.put(replay_server.url)
+    replay_server.server.serve_forever()
+
+
+def start_replay_server_process(**replay_server_kwargs):
+    """
+    Starts the replay server in its own process, so serving the payloads does not compete with the
+    measured pipeline for the GIL.
+
+    Returns:
+        Tuple[multiprocessing.Process, str]: The server process and the URL it listens on.
+    """
+    url_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(target=_serve, args=(replay_server_kwargs, url_queue), daemon=True)
+    server_process.start()
+    return server_process, url_queue.get(timeout=30)
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    return {f'p{percentile}': float(np.percentile(values, percentile)) * 1000 for percentile in (50, 90, 99)} | \
+        {'max': float(max(values)) * 1000}
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024 * 1024) if sys.platform == 'darwin' else peak_rss / 1024
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(url, tickers, time_frame='minute', currency_to_convert_to='EUR', db_path=None, max_workers=8):
+    """
+    Runs the ingestion pipeline of main.py against the replay server and times every stage separately:
+    fetch (the concurrent `BatchFetcher`, from the first request to the last frame built), currency_conversion
+    and db_write. The json_parse and frame_build time spent inside the fetch is read from the stage metrics of
+    `PolygonApiHandler.iter_polygon_data`, summed over the fetch threads.
+
+    Requests which still fail after all retries are counted, and the tickers they fail are reported with
+    their error instead of aborting the run.
+
+    Args:
+        url (str): The URL of the replay server.
+        tickers (List[str]): The tickers to ingest.
+        time_frame (str): The time frame of the bars.
+        currency_to_convert_to (str): The target currency of the conversion.
+        db_path (str, optional): The SQLite database to write to, a temporary one if None.
+        max_workers (int): Number of tickers fetched concurrently.
+
+    Returns:
+        dict: The stage durations in seconds, the request latencies in milliseconds, the failures and the
+              throughput.
+    """
+    os.environ['polygon_base_url'] = url
+    os.environ['polygon_api_version'] = 'v2'
+    os.environ['frankfurter_base_url'] = url
+    os.environ['frankfurter_api_version'] = 'v1'
+
+    from logger import metrics
+    from batch_fetcher import BatchFetcher
+    from currency_convertor import convert_currency_in_stock_price_df, get_currency_column
+    from database_writer import DatabaseWriter, SqliteBackend
+    from request_scheduler import RequestScheduler
+
+    class TimedRequestScheduler(RequestScheduler):
+        """
+        RequestScheduler recording the latency of every request, retries included, and the requests
+        which did not succeed.
+        """
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.request_seconds = []
+            self.failed_requests = defaultdict(int)
+            self._requests_lock = threading.Lock()
+
+        def get(self, url, rate_limit_key=None):
+            start = time.perf_counter()
+            try:
+                response = super().get(url, rate_limit_key=rate_limit_key)
+            except Exception as e:
+                with self._requests_lock:
+                    self.failed_requests[type(e).__name__] += 1
+                raise
+            with self._requests_lock:
+                self.request_seconds.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    self.failed_requests[str(response.status_code)] += 1
+            return response
+
+    metrics.reset()
+    stage_seconds = defaultdict(float)
+    request_scheduler = TimedRequestScheduler(pool_size=max_workers + 1)
+    batch_fetcher = BatchFetcher(tickers=tickers, date_to_fetch_from='2024-01-01', date_to_fetch_till='2024-12-31',
+                                 number_of_time_frames='1', time_frame=time_frame, adjusted='true', sort='asc',
+                                 api_key='bench', date_column_name='Date', latest=False, base_currency='USD',
+                                 max_workers=max_workers, request_scheduler=request_scheduler)
+
+    start = time.perf_counter()
+    currency_data, stock_price_data_per_ticker, errors = batch_fetcher.fetch()
+    stage_seconds['fetch'] += time.perf_counter() - start
+    stock_price_data_per_ticker = {ticker: stock_price_data for ticker, stock_price_data
+                                   in stock_price_data_per_ticker.items() if stock_price_data is not None}
+    number_of_bars = sum(len(stock_price_data) for stock_price_data in stock_price_data_per_ticker.values())
+
+    start = time.perf_counter()
+    for ticker, stock_price_data in stock_price_data_per_ticker.items():
+        if currency_data is not None:
+            stock_price_data_per_ticker[ticker], _ = convert_currency_in_stock_price_df(
+                stock_price_data=stock_price_data, latest=False, currency_data=currency_data,
+                date_column_name='Date', stock_price_column_to_convert=['o', 'c', 'h', 'l', 'vw'],
+                currency_to_convert_to=currency_to_convert_to)
+        else:
+            stock_price_data['currency'] = get_currency_column('USD', len(stock_price_data))
+    stock_price_data = BatchFetcher.combine_frames(stock_price_data_per_ticker)
+    stage_seconds['currency_conversion'] += time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database_writer = DatabaseWriter(backend=SqliteBackend(db_path or os.path.join(tmp_dir, 'bench.db')))
+        start = time.perf_counter()
+        database_writer.write_stock_price_data(stock_price_data, time_frame=time_frame)
+        stage_seconds['db_write'] += time.perf_counter() - start
+        database_writer.close()
+
+    snapshot = metrics.snapshot()
+    fetch_thread_seconds = {stage: sum(duration['sum'] for duration in snapshot['durations']
+                                       if duration['name'] == 'stage_duration_seconds'
+                                       and duration['labels'].get('stage') == metric_stage)
+                            for stage, metric_stage in (('json_parse', 'polygon_json_parse'),
+                                                        ('frame_build', 'polygon_frame_build'))}
+    total_seconds = sum(stage_seconds.values())
+    return {
+        'bars': number_of_bars,
+        'requests': len(request_scheduler.request_seconds),
+        'failed_requests': dict(request_scheduler.failed_requests),
+        'failed_tickers': errors,
+        'fx_failed': currency_data is None,
+        'stage_seconds': dict(stage_seconds),
+        'fetch_thread_seconds': fetch_thread_seconds,
+        'stage_bars_per_second': {stage: number_of_bars / seconds for stage, seconds in stage_seconds.items()
+                                  if seconds > 0},
+        'total_seconds': total_seconds,
+        'bars_per_second': number_of_bars / total_seconds if total_seconds else None,
+        'request_latency_ms': percentiles(request_scheduler.request_seconds),
+        'metrics': snapshot,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End to end benchmark of the ingestion pipeline')
+    parser.add_argument('--tickers', type=int, default=10, help='number of tickers to ingest')
+    parser.add_argument('--bars-per-ticker', type=int, default=50000)
+    parser.add_argument('--page-size', type=int, default=50000)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--recordings-dir', default=None)
+    parser.add_argument('--max-workers', type=int, default=8, help='number of tickers fetched concurrently')
+    parser.add_argument('--repeat', type=int, default=3, help='number of measured runs')
+    parser.add_argument('--output', default=None, help='JSON file to write the results to, stdout if not given')
+    args = parser.parse_args()
+
+    server_process, url = start_replay_server_process(bars_per_ticker=args.bars_per_ticker,
+                                                      page_size=args.page_size, latency_ms=args.latency_ms,
+                                                      error_rate=args.error_rate,
+                                                      recordings_dir=args.recordings_dir)
+    tickers = [f'T{ticker_index:04d}' for ticker_index in range(args.tickers)]
+    try:
+        runs = [run_benchmark(url, tickers, max_workers=args.max_workers) for _ in range(args.repeat)]
+    finally:
+        server_process.terminate()
+
+    results = {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'parameters': vars(args),
+        'runs': runs,
+        'best_bars_per_second': max(run['bars_per_second'] or 0 for run in runs),
+        'failed_requests': sum(sum(run['failed_requests'].values()) for run in runs),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+import os
+import threading
+import uuid
+from datetime import timedelta
+
+from logger import Logger, metrics
+import logging
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+from database_writer import CURRENCY_KEY, STOCK_PRICE_KEY
+from date_intervals import to_date
+from resampler import DAY_NANOSECONDS, get_local_nanoseconds
+
+FILE_FORMATS = {'parquet': 'parquet', 'ipc': 'arrow'}
+PARTITION_DATE_FORMATS = {'day': '%Y-%m-%d', 'month': '%Y-%m', 'year': '%Y'}
+STOCK_PRICE_PARTITIONING = pa.schema([('ticker', pa.string()), ('time_frame', pa.string()), ('date', pa.string())])
+CURRENCY_PARTITIONING = pa.schema([('base_currency', pa.string()), ('date', pa.string())])
+CATEGORICAL_COLUMNS = ['ticker', 'currency', 'time_frame', 'base_currency']
+
+
+class ColumnarSink:
+    def __init__(self, root_dir, file_format='parquet', partition_granularity='month', market_timezone=None):
+        """
+        Initializes the ColumnarSink class, an output of the pipeline into partitioned columnar datasets.
+
+        The converted bars are written to `<root_dir>/stock_prices` partitioned as
+        `ticker=<ticker>/time_frame=<time_frame>/date=<date>` and the exchange rates to `<root_dir>/currencies`
+        partitioned as `base_currency=<base>/date=<date>`, where the date partition is the day, month or year
+        of the trading day of the bars in `market_timezone` (post-market bars after midnight UTC stay in the
+        partition of their trading day) and of the publication date of the rates. Every write appends new files
+        with unique names, `compact` merges the files of every partition into one deduplicated and sorted file.
+        main.py and the PipelineRunner compact after every run, so bars written again by a rerun are read once.
+
+        Reads go through `pyarrow.dataset` on a memory mapped local filesystem: the partitions outside the
+        requested tickers, time frames and dates are pruned without being opened, and only the requested
+        columns are read. With the `ipc` (Arrow) format the columns are mapped straight from the page cache
+        without decoding.
+
+        Args:
+            root_dir (str): Root directory of the datasets, created if it does not exist.
+            file_format (str): The file format, "parquet" (compressed) or "ipc" (Arrow, zero-copy reads).
+            partition_granularity (str): The date partition, "day", "month" or "year".
+            market_timezone (str, optional): The timezone of the exchange, defining the trading day of the bars.
+                                             Defaults to the `market_timezone` environment variable, or
+                                             "America/New_York".
+
+        Example:
+            columnar_sink = ColumnarSink(root_dir="data/columnar")
+            columnar_sink.write_stock_price_data(stock_price_data, time_frame="minute")
+            columnar_sink.compact()
+            bars = columnar_sink.read_stock_price_data(ticker="AAPL", time_frame="minute",
+                                                       date_from="2024-01-01", date_till="2024-06-30",
+                                                       columns=["timestamp", "c"])
+        """
+        if file_format not in FILE_FORMATS:
+            raise ValueError(f"unknown file_format {file_format}, please select one of {list(FILE_FORMATS)}")
+        if partition_granularity not in PARTITION_DATE_FORMATS:
+            raise ValueError(f"unknown partition_granularity {partition_granularity}, please select one of "
+                             f"{list(PARTITION_DATE_FORMATS)}")
+        self.log = Logger(name=__name__, log_file="logs/app.log", level=logging.DEBUG).get_logger()
+        self.root_dir = root_dir
+        self.file_format = file_format
+        self.partition_granularity = partition_granularity
+        self.market_timezone = market_timezone or os.getenv('market_timezone', 'America/New_York')
+        self.filesystem = pafs.LocalFileSystem(use_mmap=True)
+        self._lock = threading.Lock()
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    @classmethod
+    def from_configs(cls, configs):
+        return cls(root_dir=configs.columnar_dir, file_format=configs.columnar_format,
+                   partition_granularity=configs.columnar_partition_granularity,
+                   market_timezone=configs.market_timezone)
+
+    def _dataset_dir(self, dataset_name):
+        return os.path.join(self.root_dir, dataset_name)
+
+    def _partition_date(self, timestamps):
+        return timestamps.dt.strftime(PARTITION_DATE_FORMATS[self.partition_granularity])
+
+    def _trading_day(self, timestamps):
+        local_nanoseconds = get_local_nanoseconds(timestamps, self.market_timezone)
+        return pd.Series((local_nanoseconds // DAY_NANOSECONDS * DAY_NANOSECONDS).view('datetime64[ns]'),
+                         index=timestamps.index)
+
+    @staticmethod
+    def _to_table(data):
+        """
+        Converts a DataFrame into an Arrow table with a stable schema across writes: categoricals become
+        strings, timestamps are stored in milliseconds and the rates are float64.
+        """
+        table = pa.Table.from_pandas(data, preserve_index=False)
+        fields = []
+        for field in table.schema:
+            if pa.types.is_dictionary(field.type):
+                field = field.with_type(pa.string())
+            elif pa.types.is_timestamp(field.type):
+                field = field.with_type(pa.timestamp('ms'))
+            fields.append(field)
+        return table.cast(pa.schema(fields).remove_metadata())
+
+    def _write(self, dataset_name, data, partitioning):
+        basename_template = f"part-{uuid.uuid4().hex}-{{i}}.{FILE_FORMATS[self.file_format]}"
+        with self._lock, metrics.span('columnar_write', dataset=dataset_name):
+            ds.write_dataset(self._to_table(data), self._dataset_dir(dataset_name), format=self.file_format,
+                             partitioning=ds.partitioning(partitioning, flavor='hive'),
+                             basename_template=basename_template, existing_data_behavior='overwrite_or_ignore',
+                             filesystem=self.filesystem)
+        metrics.increment('rows_total', len(data), stage='columnar_write')
+        self.log.info(f"successfully wrote {len(data)} rows to {self._dataset_dir(dataset_name)}")
+
+    def write_stock_price_data(self, stock_price_data, time_frame):
+        """
+        Appends converted bars to the stock price dataset, partitioned by their trading day.
+
+        Args:
+            stock_price_data (pd.DataFrame): The bars, with `ticker`, `timestamp` and `currency` columns.
+            time_frame (str): The time frame of the bars (e.g., "day", "minute").
+        """
+        if stock_price_data is None or stock_price_data.empty:
+            return
+        data = stock_price_data.assign(ticker=stock_price_data['ticker'].astype(str), time_frame=time_frame,
+                                       date=self._partition_date(self._trading_day(stock_price_data['timestamp'])))
+        self._write('stock_prices', data, STOCK_PRICE_PARTITIONING)
+
+    def write_currency_data(self, currency_data):
+        """
+        Appends exchange rates to the currency dataset.
+
+        Args:
+            currency_data (pd.DataFrame): The rates, one column per currency, with `base_currency` and
+                                          `timestamp` columns.
+        """
+        if currency_data is None or currency_data.empty:
+            return
+        rate_columns = [col for col in currency_data.columns if col not in CURRENCY_KEY]
+        data = currency_data.reset_index(drop=True).astype({col: 'float64' for col in rate_columns})
+        data = data.assign(base_currency=data['base_currency'].astype(str),
+                           date=self._partition_date(pd.to_datetime(data['timestamp'])))
+        self._write('currencies', data, CURRENCY_PARTITIONING)
+
+    def _dataset(self, dataset_name, partitioning):
+        dataset_dir = self._dataset_dir(dataset_name)
+        if not os.path.isdir(dataset_dir):
+            return None
+        dataset = ds.dataset(dataset_dir, format=self.file_format, filesystem=self.filesystem,
+                             partitioning=ds.partitioning(partitioning, flavor='hive'))
+        # the currencies of the rate files differ between base currencies, so their schemas are unified
+        schema = pa.unify_schemas([fragment.physical_schema for fragment in dataset.get_fragments()] +
+                                  [partitioning]) if dataset.files else dataset.schema
+        return ds.dataset(dataset_dir, schema=schema, format=self.file_format, filesystem=self.filesystem,
+                          partitioning=ds.partitioning(partitioning, flavor='hive'))
+
+    def _day_start(self, date, timezone):
+        # the first UTC timestamp of a day, a trading day starts at the local midnight of the exchange
+        day_start = pd.Timestamp(to_date(date))
+        if timezone is None:
+            return day_start
+        return day_start.tz_localize(timezone, nonexistent='shift_forward').tz_convert('UTC').tz_localize(None)
+
+    def _date_filter(self, date_from, date_till, timezone=None):
+        date_format = PARTITION_DATE_FORMATS[self.partition_granularity]
+        expression = None
+        if date_from is not None:
+            expression = (ds.field('date') >= pd.Timestamp(to_date(date_from)).strftime(date_format)) & \
+                         (ds.field('timestamp') >= self._day_start(date_from, timezone))
+        if date_till is not None:
+            till_expression = (ds.field('date') <= pd.Timestamp(to_date(date_till)).strftime(date_format)) & \
+                              (ds.field('timestamp') < self._day_start(to_date(date_till) + timedelta(days=1),
+                                                                       timezone))
+            expression = till_expression if expression is None else expression & till_expression
+        return expression
+
+    @staticmethod
+    def _in_filter(column_name, values):
+        if values is None:
+            return None
+        values = [values] if isinstance(values, str) else list(values)
+        return ds.field(column_name).isin(values)
+
+    def _read(self, dataset_name, partitioning, filters, columns, as_table):
+        dataset = self._dataset(dataset_name, partitioning)
+        if dataset is None:
+            return None
+        expression = None
+        for filter_expression in filters:
+            if filter_expression is not None:
+                expression = filter_expression if expression is None else expression & filter_expression
+        with metrics.span('columnar_read', dataset=dataset_name):
+            table = dataset.to_table(columns=columns, filter=expression)
+        if as_table:
+            return table
+        data = table.to_pandas()
+        for col in CATEGORICAL_COLUMNS:
+            if col in data.columns:
+                data[col] = data[col].astype('category')
+        return data
+
+    def read_stock_price_data(self, ticker=None, time_frame=None, date_from=None, date_till=None, currency=None,
+                              columns=None, as_table=False):
+        """
+        Reads bars from the stock price dataset.
+
+        Only the partitions of the requested tickers, time frames and trading days are opened and only the
+        requested columns are read. Appended files are not deduplicated until `compact` runs.
+
+        Args:
+            ticker (str or List[str], optional): The tickers to read, all if None.
+            time_frame (str or List[str], optional): The time frames to read, all if None.
+            date_from (str, optional): The first trading day to read (format: YYYY-MM-DD).
+            date_till (str, optional): The last trading day to read (format: YYYY-MM-DD), inclusive.
+            currency (str or List[str], optional): The currencies to read, all if None.
+            columns (List[str], optional): The columns to read, all if None.
+            as_table (bool): Return the Arrow table instead of converting it into a DataFrame.
+
+        Returns:
+            pd.DataFrame or pa.Table: The bars, None if nothing was written yet.
+        """
+        filters = [self._in_filter('ticker', ticker), self._in_filter('time_frame', time_frame),
+                   self._in_filter('currency', currency),
+                   self._date_filter(date_from, date_till, timezone=self.market_timezone)]
+        return self._read('stock_prices', STOCK_PRICE_PARTITIONING, filters, columns, as_table)
+
+    def read_currency_data(self, base_currency=None, date_from=None, date_till=None, columns=None, as_table=False):
+        """
+        Reads exchange rates from the currency dataset, see `read_stock_price_data`.
+        """
+        filters = [self._in_filter('base_currency', base_currency), self._date_filter(date_from, date_till)]
+        return self._read('currencies', CURRENCY_PARTITIONING, filters, columns, as_table)
+
+    def compact(self, min_files=2):
+        """
+        Merges the files of every partition holding at least `min_files` files into one file.
+
+        The merged rows are deduplicated on the key of the dataset, keeping the last written row, and
+        sorted by timestamp. The merged file is written under a temporary name and renamed before the
+        old files are removed, so readers never see a partition without data. Writes of this sink are
+        blocked while compacting, writes of other processes must not run concurrently.
+
+        Args:
+            min_files (int): The minimum number of files of a partition to compact it.
+
+        Returns:
+            int: Number of partitions compacted.
+        """
+        number_of_partitions = 0
+        with self._lock:
+            for dataset_name, key_columns in (('stock_prices', STOCK_PRICE_KEY + ['time_frame']),
+                                              ('currencies', CURRENCY_KEY)):
+                for partition_dir, _, file_names in os.walk(self._dataset_dir(dataset_name)):
+                    paths = sorted(os.path.join(partition_dir, name) for name in file_names
+                                   if name.endswith(f'.{FILE_FORMATS[self.file_format]}'))
+                    if len(paths) < min_files:
+                        continue
+                    self._compact_partition(paths, key_columns)
+                    number_of_partitions += 1
+        self.log.info(f"compacted {number_of_partitions} partitions of {self.root_dir}")
+        return number_of_partitions
+
+    def _compact_partition(self, paths, key_columns):
+        # the files are read in modification order, so the last written row of a key wins
+        paths = sorted(paths, key=lambda path: os.stat(path).st_mtime_ns)
+        table = ds.dataset(paths, format=self.file_format, filesystem=self.filesystem).to_table()
+        table = table.append_column('_row_number', pa.array(range(table.num_rows), pa.int64()))
+        key_columns = [col for col in key_columns if col in table.column_names]
+        last_rows = table.group_by(key_columns, use_threads=False).aggregate([('_row_number', 'max')])
+        table = table.take(last_rows['_row_number_max']).drop_columns(['_row_number'])
+        table = table.sort_by('timestamp')
+
+        partition_dir = os.path.dirname(paths[0])
+        compacted_path = os.path.join(partition_dir, f"part-{uuid.uuid4().hex}-0.{FILE_FORMATS[self.file_format]}")
+        tmp_path = os.path.join(partition_dir, '.compacting.tmp')
+        if self.file_format == 'parquet':
+            pq.write_table(table, tmp_path)
+        else:
+            # uncompressed, so the compacted file can still be memory mapped without decoding
+            feather.write_feather(table, tmp_path, compression='uncompressed')
+        os.replace(tmp_path, compacted_path)
+        for path in paths:
+            os.remove(path)
+        self.log.debug(f"compacted {len(paths)} files of {partition_dir} into {len(table)} rows")
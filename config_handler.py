@@ -12,6 +12,7 @@ class Configs:
 
         self.date_column_name = os.getenv('date_column_name')
         self.ticker = os.getenv('ticker')
+        self.tickers = [ticker.strip() for ticker in self.ticker.split(',') if ticker.strip()] if self.ticker else None
         self.date_to_fetch_from = os.getenv('date_to_fetch_from')
         self.date_to_fetch_till = os.getenv('date_to_fetch_till')
         self.sort = os.getenv('sort')
@@ -21,7 +22,36 @@ class Configs:
         self.polygon_api_version = os.getenv('polygon_api_version')
         self.base_currency = os.getenv('base_currency')
         self.currency_to_convert_to = os.getenv('currency_to_convert_to')
-        self.stock_price_column_to_convert = [i for i in list(os.getenv('stock_price_column_to_convert')) if i != ',']
+        self.stock_price_column_to_convert = [column.strip() for column in
+                                              os.getenv('stock_price_column_to_convert', '').split(',')
+                                              if column.strip()]
+        self.max_workers = int(os.getenv('max_workers', '8'))
+        self.bar_cache_dir = os.getenv('bar_cache_dir', '')
+        self.fx_store_dir = os.getenv('fx_store_dir', '')
+        self.fx_latest_ttl_seconds = int(os.getenv('fx_latest_ttl_seconds', '3600'))
+        self.db_backend = os.getenv('db_backend', 'sqlite')
+        self.db_path = os.getenv('db_path', 'data/financial_data.db')
+        self.db_dsn = os.getenv('db_dsn', '')
+        self.db_schema_name = os.getenv('db_schema_name', '')
+        self.db_chunk_size = int(os.getenv('db_chunk_size', '50000'))
+        self.polygon_requests_per_minute = float(os.getenv('polygon_requests_per_minute', '0'))
+        self.request_max_retries = int(os.getenv('request_max_retries', '5'))
+        self.request_timeout_seconds = float(os.getenv('request_timeout_seconds', '30'))
+        self.refresh_time_frames = [time_frame.strip() for time_frame in
+                                    os.getenv('refresh_time_frames', self.time_frame or '').split(',') if time_frame.strip()]
+        self.refresh_interval_seconds = float(os.getenv('refresh_interval_seconds', '0'))
+        self.metrics_path = os.getenv('metrics_path', '')
+        self.resample_time_frames = [time_frame.strip() for time_frame in
+                                     os.getenv('resample_time_frames', '').split(',') if time_frame.strip()]
+        self.market_timezone = os.getenv('market_timezone', 'America/New_York')
+        self.session_start = os.getenv('session_start', '')
+        self.session_end = os.getenv('session_end', '')
+        self.columnar_dir = os.getenv('columnar_dir', '')
+        self.columnar_format = os.getenv('columnar_format', 'parquet')
+        self.columnar_partition_granularity = os.getenv('columnar_partition_granularity', 'month')
+        self.pipeline_processes = int(os.getenv('pipeline_processes', '0'))
+        self.pipeline_queue_size = int(os.getenv('pipeline_queue_size', '4'))
+        self.pipeline_chunk_rows = int(os.getenv('pipeline_chunk_rows', '50000'))
         self._validate_environment_variables()
         self.log.info("all env vars initialized correctly")
 
@@ -1,8 +1,46 @@
-from typing import List, Tuple, Any
+from typing import List, Tuple, Any, Dict
 
+import numpy as np
 import pandas as pd
 
+from logger import metrics
 
+
+def get_asof_rates(timestamps: np.ndarray, currency_data: pd.DataFrame, date_column_name: str,
+                   currencies: List[str]) -> np.ndarray:
+    """
+        Looks up the exchange rate valid at every timestamp, the last rate published on or before it.
+
+        The rate table is sorted once and every timestamp is located with a binary search, so intraday
+        bars get the rate of their day and weekends and holidays get the rate of the last publication day.
+        Timestamps before the first published rate get the first rate of the table.
+
+        Args:
+            timestamps (np.ndarray): The timestamps to look up, as datetime64 values.
+            currency_data (pd.DataFrame): DataFrame containing the currency exchange rates and a date column.
+            date_column_name (str): The name of the date column in the currency data.
+            currencies (List[str]): The currencies to look up.
+
+        Returns:
+            np.ndarray: A float64 array of shape (len(timestamps), len(currencies)) with the valid rates.
+        """
+    rate_dates = pd.to_datetime(currency_data[date_column_name]).to_numpy(dtype='datetime64[ns]')
+    order = np.argsort(rate_dates, kind='stable')
+    rates = currency_data[currencies].iloc[order].ffill().bfill().to_numpy(dtype=np.float64)
+
+    rate_indices = np.searchsorted(rate_dates[order], np.asarray(timestamps, dtype='datetime64[ns]'), side='right') - 1
+    np.clip(rate_indices, 0, None, out=rate_indices)
+    return rates[rate_indices]
+
+
+def get_currency_column(currency: str, length: int) -> pd.Categorical:
+    """
+        Returns a categorical column holding the same currency on every row.
+        """
+    return pd.Categorical.from_codes(np.zeros(length, dtype=np.int8), categories=[currency])
+
+
+@metrics.timer('currency_conversion')
 def convert_currency_in_stock_price_df(stock_price_data: pd.DataFrame, latest: int, currency_data: pd.DataFrame,
                                        date_column_name: str,
                                        stock_price_column_to_convert: List[str],
@@ -11,9 +49,10 @@ def convert_currency_in_stock_price_df(stock_price_data: pd.DataFrame, latest: i
         Converts stock prices in a DataFrame from one currency to another based on the provided currency data.
 
         This function adjusts the stock prices in the `stock_price_data` DataFrame by multiplying them with
-        the corresponding exchange rates from the `currency_data` DataFrame. It handles both the latest data
-        scenario and historical data by merging the data on the provided date column. The function also
-        interpolates missing currency values for historical data.
+        the exchange rate valid at each bar's timestamp, the last rate published on or before it (see
+        `get_asof_rates`). The same as-of lookup serves both the latest data scenario and historical data, so
+        weekends, holidays and intraday bars are converted with the previous valid rate. All price columns are
+        multiplied in one NumPy broadcast and written back into `stock_price_data` without copying the frame.
 
         Args:
             stock_price_data (pd.DataFrame): DataFrame containing stock prices to be converted.
@@ -21,6 +60,7 @@ def convert_currency_in_stock_price_df(stock_price_data: pd.DataFrame, latest: i
             currency_data (pd.DataFrame): DataFrame containing the currency exchange rates, including the target currency.
             date_column_name (str): The name of the date column in both stock price and currency data.
             stock_price_column_to_convert (List[str]): List of column names in `stock_price_data` containing the stock prices to be converted.
+                                                       When empty, no price is converted and only the currency is set.
             currency_to_convert_to (str): The target currency to convert the stock prices into.
 
         Returns:
@@ -36,25 +76,113 @@ def convert_currency_in_stock_price_df(stock_price_data: pd.DataFrame, latest: i
                                                                         currency_to_convert_to="EUR")
         """
     if stock_price_data is not None and currency_data is not None:
-        if latest:
-            stock_price_data = stock_price_data.merge(currency_data[[date_column_name, currency_to_convert_to]],
-                                                      how='cross')
-            stock_price_data[stock_price_column_to_convert] = stock_price_data[stock_price_column_to_convert].apply(
-                lambda x: x * stock_price_data[currency_to_convert_to])
-            stock_price_data.drop(
-                columns=[date_column_name + '_x', date_column_name + '_y', currency_to_convert_to],
-                inplace=True, axis=1)
-
-        else:
-            stock_price_data = stock_price_data.merge(currency_data[[date_column_name, currency_to_convert_to]],
-                                                      on=date_column_name, how='left')
-            if stock_price_data[currency_to_convert_to].isna().sum() > 0:
-                stock_price_data[currency_to_convert_to].interpolate()
-
-            stock_price_data[stock_price_column_to_convert] = stock_price_data[stock_price_column_to_convert].apply(
-                lambda x: x * stock_price_data[currency_to_convert_to])
-            stock_price_data.drop(currency_to_convert_to, inplace=True, axis=1)
+        if stock_price_column_to_convert:
+            rates = get_asof_rates(stock_price_data['timestamp'].to_numpy(), currency_data, date_column_name,
+                                   [currency_to_convert_to])
+            prices = stock_price_data[stock_price_column_to_convert].to_numpy(dtype=np.float64)
+            price_dtype = np.result_type(*stock_price_data[stock_price_column_to_convert].dtypes)
+            stock_price_data[stock_price_column_to_convert] = (prices * rates).astype(price_dtype, copy=False)
+        metrics.increment('rows_total', len(stock_price_data), stage='currency_conversion')
+        if date_column_name in stock_price_data.columns:
             stock_price_data.drop(date_column_name, inplace=True, axis=1)
 
-    stock_price_data['currency'] = currency_to_convert_to
-    return stock_price_data, max(stock_price_data['timestamp'])
+    stock_price_data['currency'] = get_currency_column(currency_to_convert_to, len(stock_price_data))
+    return stock_price_data, stock_price_data['timestamp'].max()
+
+
+@metrics.timer('currency_conversion')
+def convert_currency_to_many(stock_price_data: pd.DataFrame, currency_data: pd.DataFrame, date_column_name: str,
+                             stock_price_column_to_convert: List[str],
+                             currencies_to_convert_to: List[str]) -> Tuple[Dict[str, pd.DataFrame], Any]:
+    """
+        Converts stock prices in a DataFrame into several target currencies in one pass.
+
+        The rates of all target currencies are looked up together and the prices of every target currency
+        are computed in a single broadcast of shape (currencies, bars, columns). The columns which are not
+        converted are shared between the returned DataFrames instead of being copied.
+
+        Args:
+            stock_price_data (pd.DataFrame): DataFrame containing stock prices to be converted.
+            currency_data (pd.DataFrame): DataFrame containing the currency exchange rates, including the target currencies.
+            date_column_name (str): The name of the date column in both stock price and currency data.
+            stock_price_column_to_convert (List[str]): List of column names in `stock_price_data` containing the stock prices to be converted.
+            currencies_to_convert_to (List[str]): The target currencies to convert the stock prices into.
+
+        Returns:
+            Dict[str, pd.DataFrame]: The adjusted stock price DataFrame per target currency.
+            timestamp: of the latest observation from the stock_price_data 'timestamp' column
+
+        Example:
+            adjusted_stock_prices, timestamp = convert_currency_to_many(stock_price_data=stock_df,
+                                                                         currency_data=currency_df,
+                                                                         date_column_name="Date",
+                                                                         stock_price_column_to_convert=["o", "c"],
+                                                                         currencies_to_convert_to=["EUR", "ILS"])
+        """
+    if stock_price_column_to_convert:
+        rates = get_asof_rates(stock_price_data['timestamp'].to_numpy(), currency_data, date_column_name,
+                               currencies_to_convert_to)
+        prices = stock_price_data[stock_price_column_to_convert].to_numpy(dtype=np.float64)
+        price_dtype = np.result_type(*stock_price_data[stock_price_column_to_convert].dtypes)
+        converted_prices = (prices[np.newaxis, :, :] * rates.T[:, :, np.newaxis]).astype(price_dtype, copy=False)
+
+    metrics.increment('rows_total', len(stock_price_data) * len(currencies_to_convert_to), stage='currency_conversion')
+    column_positions = {col: col_index for col_index, col in enumerate(stock_price_column_to_convert)}
+    adjusted_stock_price_data = {}
+    for currency_index, currency in enumerate(currencies_to_convert_to):
+        columns = {col: converted_prices[currency_index, :, column_positions[col]] if col in column_positions
+                   else stock_price_data[col]
+                   for col in stock_price_data.columns if col != date_column_name}
+        adjusted_data = pd.DataFrame(columns, index=stock_price_data.index, copy=False)
+        adjusted_data['currency'] = get_currency_column(currency, len(adjusted_data))
+        adjusted_stock_price_data[currency] = adjusted_data
+
+    return adjusted_stock_price_data, stock_price_data['timestamp'].max()
+
+
+@metrics.timer('currency_conversion')
+def convert_currency_with_cross_rates(stock_price_data: pd.DataFrame, cross_rate_cube, date_column_name: str,
+                                      stock_price_column_to_convert: List[str], currency_to_convert_to: str,
+                                      currency_to_convert_from) -> Tuple[pd.DataFrame, Any]:
+    """
+        Converts stock prices from their listing currency into any currency with a `CrossRateCube`.
+
+        Unlike `convert_currency_in_stock_price_df`, the prices do not have to be quoted in the base currency
+        of the fetched rates: every bar is converted from its own currency, so bars of tickers listed in
+        different currencies can be converted together with the rates of a single Frankfurter download.
+
+        Args:
+            stock_price_data (pd.DataFrame): DataFrame containing stock prices to be converted.
+            cross_rate_cube (CrossRateCube): The cross rates between every pair of currencies.
+            date_column_name (str): The name of the date column in the stock price data, dropped after the conversion.
+            stock_price_column_to_convert (List[str]): List of column names in `stock_price_data` containing the stock prices to be converted.
+            currency_to_convert_to (str): The target currency to convert the stock prices into.
+            currency_to_convert_from (str or array-like): The listing currency of the prices, one for all bars or
+                                                          one per bar. The bars of Polygon do not carry it.
+
+        Returns:
+            pd.DataFrame: The adjusted stock price DataFrame with converted prices in the specified target currency.
+            timestamp: of the latest observation from the stock_price_data 'timestamp' column
+
+        Example:
+            cross_rate_cube = CrossRateCube.from_currency_data(currency_df, date_column_name="Date")
+            adjusted_stock_prices, _ = convert_currency_with_cross_rates(stock_price_data=stock_df,
+                                                                         cross_rate_cube=cross_rate_cube,
+                                                                         date_column_name="Date",
+                                                                         stock_price_column_to_convert=["c"],
+                                                                         currency_to_convert_to="ILS",
+                                                                         currency_to_convert_from="EUR")
+        """
+    if stock_price_column_to_convert:
+        rates = cross_rate_cube.lookup(currency_to_convert_from, currency_to_convert_to,
+                                       stock_price_data['timestamp'].to_numpy())
+        prices = stock_price_data[stock_price_column_to_convert].to_numpy(dtype=np.float64)
+        price_dtype = np.result_type(*stock_price_data[stock_price_column_to_convert].dtypes)
+        stock_price_data[stock_price_column_to_convert] = (prices * np.reshape(rates, (-1, 1))).astype(
+            price_dtype, copy=False)
+    metrics.increment('rows_total', len(stock_price_data), stage='currency_conversion')
+    if date_column_name in stock_price_data.columns:
+        stock_price_data.drop(date_column_name, inplace=True, axis=1)
+
+    stock_price_data['currency'] = get_currency_column(currency_to_convert_to, len(stock_price_data))
+    return stock_price_data, stock_price_data['timestamp'].max()
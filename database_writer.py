@@ -0,0 +1,317 @@
+import io
+import os
+import sqlite3
+import threading
+
+from logger import Logger, metrics
+import logging
+import numpy as np
+import pandas as pd
+
+TIME_FRAMES = ['second', 'minute', 'hour', 'day', 'week', 'month', 'quarter', 'year']
+
+STOCK_PRICE_COLUMNS = {'v': 'float', 'vw': 'float', 'o': 'float', 'c': 'float', 'h': 'float', 'l': 'float',
+                       't': 'bigint', 'n': 'int', 'timestamp': 'timestamp', 'ticker': 'varchar(20)',
+                       'currency': 'varchar(20)'}
+STOCK_PRICE_KEY = ['ticker', 'timestamp', 'currency']
+
+CURRENCIES = ['AUD', 'BGN', 'BRL', 'CAD', 'CHF', 'CNY', 'CZK', 'DKK', 'EUR', 'GBP', 'HKD', 'HUF', 'IDR', 'ILS',
+              'INR', 'ISK', 'JPY', 'KRW', 'MXN', 'MYR', 'NOK', 'NZD', 'PHP', 'PLN', 'RON', 'SEK', 'SGD', 'THB',
+              'TRY', 'USD', 'ZAR']
+CURRENCY_COLUMNS = {**{currency: 'float' for currency in CURRENCIES}, 'base_currency': 'varchar(20)',
+                    'timestamp': 'timestamp'}
+CURRENCY_KEY = ['base_currency', 'timestamp']
+
+
+class SqliteBackend:
+    placeholder = '?'
+    serial_primary_key = 'integer primary key autoincrement'
+
+    def __init__(self, db_path):
+        """
+        SQLite backend of the DatabaseWriter, used for local runs.
+
+        Args:
+            db_path (str): Path of the SQLite database file, created if it does not exist.
+        """
+        self.db_path = db_path
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+
+    def table_name(self, schema_name, table_name):
+        return table_name
+
+    def create_schema(self, schema_name):
+        pass
+
+    def bulk_upsert(self, cursor, table_name, columns, key_columns, rows):
+        cursor.executemany(upsert_statement(table_name, columns, key_columns, self.placeholder), rows)
+
+    def close(self):
+        self.connection.close()
+
+
+class PostgresBackend:
+    placeholder = '%s'
+    serial_primary_key = 'serial primary key'
+
+    def __init__(self, dsn):
+        """
+        Postgres backend of the DatabaseWriter, loads rows with COPY into a temporary table
+        which is then merged into the target table with a single upsert statement.
+
+        Args:
+            dsn (str): The connection string of the Postgres database, requires the psycopg2 package.
+        """
+        try:
+            import psycopg2
+        except ImportError as e:
+            raise ImportError("the postgres backend requires the psycopg2 package, please install it") from e
+        self.connection = psycopg2.connect(dsn)
+
+    def table_name(self, schema_name, table_name):
+        return f'{schema_name}.{table_name}' if schema_name else table_name
+
+    def create_schema(self, schema_name):
+        if schema_name:
+            with self.connection.cursor() as cursor:
+                cursor.execute(f'create schema if not exists {schema_name}')
+
+    def bulk_upsert(self, cursor, table_name, columns, key_columns, rows):
+        staging_table = 'staging_' + table_name.split('.')[-1]
+        cursor.execute(f'create temporary table if not exists {staging_table} '
+                       f'(like {table_name} including defaults) on commit drop')
+        buffer = io.StringIO()
+        pd.DataFrame(rows, columns=columns).to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        cursor.copy_expert(f"copy {staging_table} ({', '.join(columns)}) from stdin with (format csv)", buffer)
+        cursor.execute(upsert_statement(table_name, columns, key_columns, select_from=staging_table))
+        cursor.execute(f'truncate {staging_table}')
+
+    def close(self):
+        self.connection.close()
+
+
+def upsert_statement(table_name, columns, key_columns, placeholder='?', select_from=None):
+    """
+    Builds an INSERT statement which updates the existing row when a row with the same key already exists.
+
+    Args:
+        table_name (str): The table to insert to.
+        columns (List[str]): The columns to insert.
+        key_columns (List[str]): The columns of the unique key of the table.
+        placeholder (str): The parameter placeholder of the database driver.
+        select_from (str, optional): Insert the rows of this table instead of one row of parameters.
+
+    Returns:
+        str: The upsert statement.
+    """
+    values = f"select {', '.join(columns)} from {select_from}" if select_from else \
+        f"values ({', '.join([placeholder] * len(columns))})"
+    updates = ', '.join(f'{column} = excluded.{column}' for column in columns if column not in key_columns)
+    return f"insert into {table_name} ({', '.join(columns)}) {values} " \
+           f"on conflict ({', '.join(key_columns)}) do update set {updates}"
+
+
+def frame_to_rows(data, columns):
+    """
+    Converts the columns of a DataFrame into a list of tuples of Python values, column by column,
+    so no per row DataFrame access is needed. Timestamps are converted to ISO strings and missing values to None.
+    """
+    values = []
+    for column in columns:
+        if column not in data.columns:
+            values.append([None] * len(data))
+        elif pd.api.types.is_datetime64_any_dtype(data[column]):
+            timestamps = np.datetime_as_string(data[column].to_numpy(dtype='datetime64[ms]'), unit='ms')
+            values.append([None if timestamp == 'NaT' else timestamp.replace('T', ' ') for timestamp in timestamps])
+        elif data[column].hasnans:
+            values.append([None if pd.isna(value) else value for value in data[column].tolist()])
+        else:
+            values.append(data[column].tolist())
+    return list(zip(*values))
+
+
+class DatabaseWriter:
+    def __init__(self, backend, schema_name=None, chunk_size=50000):
+        """
+        Initializes the DatabaseWriter class, which loads the stock price and currency data
+        into the tables described in SQL_DDL.txt.
+
+        Tables and their indexes are created on demand, one stock price table per `time_frame`.
+        Rows are loaded in chunks of `chunk_size` rows with one bulk statement per chunk, and every
+        call is executed in one transaction. Rows are upserted on the unique key of the table,
+        (ticker, timestamp, currency) for stock prices and (base_currency, timestamp) for currencies,
+        so loading the same data again does not duplicate rows.
+
+        Args:
+            backend (SqliteBackend | PostgresBackend): The database backend to write to.
+            schema_name (str, optional): The schema of the tables, ignored by the SQLite backend.
+            chunk_size (int): Number of rows sent to the database in every bulk statement.
+
+        Example:
+            database_writer = DatabaseWriter(backend=SqliteBackend(db_path="data/financial_data.db"))
+            database_writer.write_stock_price_data(stock_price_data, time_frame="day")
+            database_writer.write_currency_data(currency_data)
+        """
+        self.log = Logger(name=__name__, log_file="logs/app.log", level=logging.DEBUG).get_logger()
+        self.backend = backend
+        self.schema_name = schema_name
+        self.chunk_size = chunk_size
+        self._created_tables = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_configs(cls, configs):
+        """
+        Creates a DatabaseWriter from the `db_*` values of the Configs class.
+        """
+        if configs.db_backend == 'postgres':
+            backend = PostgresBackend(dsn=configs.db_dsn)
+        elif configs.db_backend == 'sqlite':
+            backend = SqliteBackend(db_path=configs.db_path)
+        else:
+            raise ValueError(f"unknown database backend {configs.db_backend}, please select sqlite or postgres")
+        return cls(backend=backend, schema_name=configs.db_schema_name, chunk_size=configs.db_chunk_size)
+
+    @staticmethod
+    def stock_price_table_name(time_frame):
+        if time_frame not in TIME_FRAMES:
+            raise ValueError(f"unknown time_frame {time_frame}, please select one of {TIME_FRAMES}")
+        return f'stock_price_data_{time_frame}_table'
+
+    def _create_table(self, table_name, columns, id_column, key_columns, index_columns, index_prefix):
+        qualified_table_name = self.backend.table_name(self.schema_name, table_name)
+        if qualified_table_name in self._created_tables:
+            return qualified_table_name
+
+        column_definitions = ', '.join([f'{id_column} {self.backend.serial_primary_key}'] +
+                                       [f'{column} {column_type}' + (' not null' if column in key_columns else '')
+                                        for column, column_type in columns.items()])
+        with self._lock, self.backend.connection:
+            cursor = self.backend.connection.cursor()
+            self.backend.create_schema(self.schema_name)
+            cursor.execute(f'create table if not exists {qualified_table_name} ({column_definitions})')
+            cursor.execute(f"create unique index if not exists {table_name}_key "
+                           f"on {qualified_table_name} ({', '.join(key_columns)})")
+            for column in index_columns:
+                cursor.execute(f'create index if not exists {index_prefix}_{column} on {qualified_table_name} ({column})')
+
+        self._created_tables.add(qualified_table_name)
+        return qualified_table_name
+
+    def _write(self, data, table_name, columns, key_columns):
+        rows = frame_to_rows(data, columns)
+        try:
+            with metrics.span('db_write', table=table_name), self._lock, self.backend.connection:
+                cursor = self.backend.connection.cursor()
+                for chunk_start in range(0, len(rows), self.chunk_size):
+                    self.backend.bulk_upsert(cursor, table_name, columns, key_columns,
+                                             rows[chunk_start:chunk_start + self.chunk_size])
+            metrics.increment('rows_total', len(rows), stage='db_write')
+        except Exception as e:
+            self.log.error(f"failed to write {len(rows)} rows to {table_name}, the transaction was rolled back: {e}")
+            raise
+        self.log.info(f"successfully wrote {len(rows)} rows to {table_name}")
+
+    def write_stock_price_data(self, stock_price_data, time_frame):
+        """
+        Upserts stock price data into the stock price table of the time frame.
+
+        Args:
+            stock_price_data (pd.DataFrame): The stock prices, with the columns of STOCK_PRICE_COLUMNS.
+            time_frame (str): The time frame of the data (e.g., "day", "minute"), selects the table.
+        """
+        if stock_price_data is None or stock_price_data.empty:
+            return
+        table_name = self._create_stock_price_table(time_frame)
+        self._write(stock_price_data, table_name, list(STOCK_PRICE_COLUMNS), STOCK_PRICE_KEY)
+
+    def _create_stock_price_table(self, time_frame):
+        return self._create_table(self.stock_price_table_name(time_frame), STOCK_PRICE_COLUMNS, 'price_id',
+                                  STOCK_PRICE_KEY, index_columns=['timestamp', 'ticker', 'currency'],
+                                  index_prefix=f'idx_stock_price_data_{time_frame}')
+
+    def get_latest_timestamp(self, ticker, time_frame, currency):
+        """
+        Returns the timestamp of the newest stored bar of a ticker, used to fetch only newer bars.
+
+        Args:
+            ticker (str): The stock ticker symbol.
+            time_frame (str): The time frame of the bars (e.g., "day", "minute"), selects the table.
+            currency (str): The currency the bars were stored in.
+
+        Returns:
+            pd.Timestamp: The newest stored timestamp, None if no bar of the ticker is stored.
+        """
+        table_name = self._create_stock_price_table(time_frame)
+        placeholder = self.backend.placeholder
+        with self._lock:
+            cursor = self.backend.connection.cursor()
+            cursor.execute(f'select max(timestamp) from {table_name} '
+                           f'where ticker = {placeholder} and currency = {placeholder}', (ticker, currency))
+            latest_timestamp = cursor.fetchone()[0]
+            self.backend.connection.commit()
+        return pd.Timestamp(latest_timestamp) if latest_timestamp is not None else None
+
+    def read_stock_price_data(self, time_frame, tickers, currencies, timestamp_from, timestamp_till):
+        """
+        Reads the stored bars of tickers in a half open range of timestamps, used to roll stored fine bars up
+        into coarser time frames.
+
+        Args:
+            time_frame (str): The time frame of the bars (e.g., "day", "minute"), selects the table.
+            tickers (List[str]): The stock ticker symbols.
+            currencies (List[str]): The currencies the bars were stored in.
+            timestamp_from (pd.Timestamp): The first timestamp of the range, included.
+            timestamp_till (pd.Timestamp): The end of the range, excluded.
+
+        Returns:
+            pd.DataFrame: The bars with the columns of STOCK_PRICE_COLUMNS, sorted by ticker, currency and `t`.
+        """
+        table_name = self._create_stock_price_table(time_frame)
+        placeholder = self.backend.placeholder
+        tickers, currencies = list(tickers), list(currencies)
+        columns = list(STOCK_PRICE_COLUMNS)
+        timestamps = np.datetime_as_string(np.array([timestamp_from, timestamp_till], dtype='datetime64[ms]'),
+                                           unit='ms')
+        with self._lock:
+            cursor = self.backend.connection.cursor()
+            cursor.execute(f"select {', '.join(columns)} from {table_name} "
+                           f"where ticker in ({', '.join([placeholder] * len(tickers))}) "
+                           f"and currency in ({', '.join([placeholder] * len(currencies))}) "
+                           f"and timestamp >= {placeholder} and timestamp < {placeholder} "
+                           f"order by ticker, currency, t",
+                           (*tickers, *currencies, *[timestamp.replace('T', ' ') for timestamp in timestamps]))
+            rows = cursor.fetchall()
+            self.backend.connection.commit()
+
+        stock_price_data = pd.DataFrame.from_records(rows, columns=columns)
+        stock_price_data['timestamp'] = pd.to_datetime(stock_price_data['timestamp'])
+        stock_price_data['t'] = stock_price_data['t'].astype(np.int64)
+        for column, column_type in STOCK_PRICE_COLUMNS.items():
+            if column_type == 'float' or (column_type == 'int' and stock_price_data[column].hasnans):
+                stock_price_data[column] = stock_price_data[column].astype(np.float64)
+        return stock_price_data
+
+    def write_currency_data(self, currency_data):
+        """
+        Upserts currency data into the currency table.
+
+        Args:
+            currency_data (pd.DataFrame): The exchange rates, with the columns of CURRENCY_COLUMNS.
+        """
+        if currency_data is None or currency_data.empty:
+            return
+        unknown_columns = set(currency_data.columns) - set(CURRENCY_COLUMNS)
+        if unknown_columns:
+            self.log.debug(f"columns {sorted(unknown_columns)} are not part of the currency table and are not written")
+        table_name = self._create_table('currency_data_table', CURRENCY_COLUMNS, 'currency_id', CURRENCY_KEY,
+                                        index_columns=['base_currency', 'timestamp'],
+                                        index_prefix='currency_data_table')
+        self._write(currency_data, table_name, list(CURRENCY_COLUMNS), CURRENCY_KEY)
+
+    def close(self):
+        self.backend.close()
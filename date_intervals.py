@@ -0,0 +1,64 @@
+from datetime import date, datetime, timedelta
+from typing import List, Tuple
+
+DateInterval = Tuple[date, date]
+
+
+def to_date(value) -> date:
+    """
+    Converts a YYYY-MM-DD string, a datetime or a date into a date.
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+
+
+def merge_intervals(intervals: List[DateInterval]) -> List[DateInterval]:
+    """
+    Merges overlapping and adjacent closed date intervals.
+
+    Args:
+        intervals (List[Tuple[date, date]]): Closed intervals, in any order.
+
+    Returns:
+        List[Tuple[date, date]]: Sorted, non overlapping intervals covering the same dates.
+
+    Example:
+        merge_intervals([(date(2024, 1, 5), date(2024, 1, 9)), (date(2024, 1, 1), date(2024, 1, 4))])
+        # [(date(2024, 1, 1), date(2024, 1, 9))]
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + timedelta(days=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def missing_intervals(requested: DateInterval, held: List[DateInterval]) -> List[DateInterval]:
+    """
+    Returns the parts of the requested interval which are not covered by the held intervals.
+
+    Args:
+        requested (Tuple[date, date]): The closed interval that is needed.
+        held (List[Tuple[date, date]]): The closed intervals already available.
+
+    Returns:
+        List[Tuple[date, date]]: Sorted gaps of the requested interval, empty if it is fully held.
+    """
+    start, end = requested
+    gaps = []
+    for held_start, held_end in merge_intervals(held):
+        if held_end < start or held_start > end:
+            continue
+        if held_start > start:
+            gaps.append((start, held_start - timedelta(days=1)))
+        start = max(start, held_end + timedelta(days=1))
+        if start > end:
+            return gaps
+    if start <= end:
+        gaps.append((start, end))
+    return gaps
@@ -1,7 +1,8 @@
-import requests
 import os
 from datetime import datetime
-from logger import Logger
+from logger import Logger, metrics
+from request_scheduler import RequestScheduler
+from json_decoder import decode_frankfurter_response
 import logging
 import pandas as pd
 from dotenv import load_dotenv
@@ -11,7 +12,7 @@ load_dotenv()
 
 class FrankfurterApiHandler:
     def __init__(self, ticker, date_to_fetch_from, date_to_fetch_till,
-                 base_currency, date_column_name, latest):
+                 base_currency, date_column_name, latest, request_scheduler=None, rate_store=None):
         """
             Initializes the FrankfurterApiHandler class with parameters necessary for
             fetching exchange rate data from the Frankfurter API.
@@ -27,6 +28,12 @@ class FrankfurterApiHandler:
                 base_currency (str): The base currency for the exchange rate data (e.g., "USD").
                 date_column_name (str): The name of the date column in the resulting DataFrame.
                 latest (bool): If True, fetch the latest exchange rates for the base currency; if False, fetch historical rates.
+                request_scheduler (RequestScheduler, optional): Shared scheduler all requests are sent through, it
+                                                                retries failed requests and reuses keep-alive
+                                                                connections across handlers. A new scheduler is
+                                                                created if not given.
+                rate_store (FxRateStore, optional): Shared store of exchange rates, when given only the rates
+                                                    missing from the store are fetched from the API.
 
             Attributes:
                 date_to_fetch_from (str): The start date for data fetching.
@@ -35,6 +42,8 @@ class FrankfurterApiHandler:
                 latest (bool): Flag indicating if the latest data is requested.
                 ticker (str): The stock ticker symbol.
                 date_column_name (str): The name of the date column in the resulting DataFrame.
+                request_scheduler (RequestScheduler): The scheduler used for all requests of this handler.
+                rate_store (FxRateStore): The shared store of exchange rates, None if not used.
 
             Example:
                 # Example of initializing the class
@@ -52,11 +61,43 @@ class FrankfurterApiHandler:
         self.date_to_fetch_till = date_to_fetch_till
         self.base_currency = base_currency
         self.latest = latest
-        self.frankfurter_url = f"{self.frankfurter_base_url}/{self.frankfurter_api_version}/{self.date_to_fetch_from}..{self.date_to_fetch_till}?base={self.base_currency}" \
+        self.frankfurter_url = self._build_frankfurter_url(self.date_to_fetch_from, self.date_to_fetch_till) \
             if not latest else f"{self.frankfurter_base_url}/{self.frankfurter_api_version}/latest?base={self.base_currency}"
         self.ticker = ticker
+        self.request_scheduler = request_scheduler if request_scheduler is not None else RequestScheduler()
+        self.rate_store = rate_store
         self.log = Logger(name=__name__, log_file="logs/app.log", level=logging.DEBUG).get_logger()
 
+    def _build_frankfurter_url(self, date_to_fetch_from, date_to_fetch_till):
+        return f"{self.frankfurter_base_url}/{self.frankfurter_api_version}/{date_to_fetch_from}..{date_to_fetch_till}?base={self.base_currency}"
+
+    def _fetch_rates(self, frankfurter_url):
+        """
+            Fetches exchange rates from the Frankfurter API.
+
+            Args:
+                frankfurter_url (str): The URL to request.
+
+            Returns:
+                pd.DataFrame: The exchange rates with the dates as the index and the currencies as columns
+                              if the request was successful; else, None.
+            """
+        frankfurter_response = self.request_scheduler.get(frankfurter_url, rate_limit_key='frankfurter')
+        rates = None
+
+        if frankfurter_response.status_code == 200:
+            dates, currencies, rate_matrix, data = decode_frankfurter_response(frankfurter_response.content)
+            if dates is None:
+                self.log.error(f"one of the variables in the URL is wrong {frankfurter_url}")
+            elif dates:
+                if 'date' in data:
+                    dates = [str(datetime.now().date())]
+                rates = pd.DataFrame(rate_matrix, index=dates, columns=currencies, copy=False)
+        else:
+            self.log.error(f"Error {frankfurter_response.status_code}: {frankfurter_response.text}")
+
+        return rates
+
     def get_frankfurter_data(self):
         """
             Fetches exchange rate data from the Frankfurter API and adjusts it into a DataFrame.
@@ -66,6 +107,9 @@ class FrankfurterApiHandler:
             the exchange rate data, and then formats it into a DataFrame with a date column. The function
             handles both cases when the API returns a flat dictionary of rates or a nested structure.
 
+            When a rate store is configured the rates are served from it, and only the date ranges it
+            does not hold yet (or expired `latest` rates) are requested from the API.
+
             The function logs the success of the request or any errors that occur during the process.
 
             Returns:
@@ -74,26 +118,22 @@ class FrankfurterApiHandler:
                                else, None.
 
             """
-        frankfurter_response = requests.get(self.frankfurter_url)
-        adjusted_data = None
-
-        if frankfurter_response.status_code == 200:
-            data = frankfurter_response.json()
-            if 'rates' in data.keys():
-
-                data = data['rates']
-            else:
-                self.log.error(f"one of the variables in the URL is wrong {self.frankfurter_url}")
-            if isinstance(list(data.values())[0], float):
-                adjusted_data = pd.DataFrame({str(datetime.now().date()): data}).transpose()
-
-            else:
-                adjusted_data = pd.DataFrame(data).transpose()
-
-            adjusted_data[self.date_column_name] = adjusted_data.index
-            adjusted_data['base_currency'] = self.base_currency
-            self.log.info(f"successfully got data for ticker {self.ticker}:")
+        if self.rate_store is None:
+            rates = self._fetch_rates(self.frankfurter_url)
+        elif self.latest:
+            rates = self.rate_store.get_latest(self.base_currency, lambda: self._fetch_rates(self.frankfurter_url))
         else:
-            self.log.error(f"Error {frankfurter_response.status_code}: {frankfurter_response.text}")
+            rates = self.rate_store.get_rates(
+                self.base_currency, self.date_to_fetch_from, self.date_to_fetch_till,
+                lambda date_from, date_till: self._fetch_rates(self._build_frankfurter_url(date_from, date_till)))
+
+        if rates is None:
+            return None
+
+        metrics.increment('rows_total', len(rates), stage='frankfurter_fetch')
+        adjusted_data = rates.copy()
+        adjusted_data[self.date_column_name] = adjusted_data.index
+        adjusted_data['base_currency'] = self.base_currency
+        self.log.info(f"successfully got data for ticker {self.ticker}:")
 
         return adjusted_data
@@ -0,0 +1,138 @@
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+NON_RATE_COLUMNS = ['base_currency', 'timestamp']
+
+
+class CrossRateCube:
+    def __init__(self, first_date, currencies: List[str], cube: np.ndarray):
+        """
+        Initializes the CrossRateCube class, a dense cube of the exchange rates between every pair of
+        currencies on every day.
+
+        `cube[day, from_index, to_index]` is the number of units of the `to` currency one unit of the `from`
+        currency buys on `first_date + day`. The days are consecutive, so the rates of a timestamp are found
+        by subtracting `first_date` from its day instead of searching.
+
+        Args:
+            first_date (np.datetime64): The first day of the cube.
+            currencies (List[str]): The currencies of the second and third axes of the cube.
+            cube (np.ndarray): The rates, of shape (days, len(currencies), len(currencies)).
+
+        Example:
+            cross_rate_cube = CrossRateCube.from_currency_data(currency_data, date_column_name="Date")
+            rates = cross_rate_cube.lookup("EUR", "ILS", stock_price_data["timestamp"].to_numpy())
+        """
+        self.first_date = np.datetime64(first_date, 'D')
+        self.currencies = list(currencies)
+        self.currency_indices = {currency: index for index, currency in enumerate(self.currencies)}
+        self.cube = cube
+
+    @classmethod
+    def from_currency_data(cls, currency_data: pd.DataFrame, date_column_name: str, base_currency: str = None,
+                           currencies: List[str] = None):
+        """
+        Builds the cube from the rates of one base currency, as returned by `FrankfurterApiHandler`.
+
+        Every cross rate is triangulated through the base: one unit of `a` buys `rate[b] / rate[a]` units
+        of `b`. The publication days are spread over a daily calendar and the days without a publication
+        (weekends, holidays) carry the last published rates forward. The calendar starts on the first day on
+        which every currency has a rate, so no rate of the cube is NaN, and ends on the last publication day.
+
+        Args:
+            currency_data (pd.DataFrame): The rates of the base currency, one column per currency, with a
+                                          date column and a `base_currency` column.
+            date_column_name (str): The name of the date column in the currency data.
+            base_currency (str, optional): The base currency of the rates, read from the `base_currency`
+                                           column if not given.
+            currencies (List[str], optional): The currencies to keep in the cube, all of them if not given.
+
+        Returns:
+            CrossRateCube: The cube of the rates.
+
+        Raises:
+            ValueError: If there is no day on which every currency has a rate.
+        """
+        if base_currency is None:
+            base_currency = str(currency_data['base_currency'].iloc[0])
+        rate_columns = [col for col in currency_data.columns
+                        if col not in NON_RATE_COLUMNS + [date_column_name, base_currency]]
+        if currencies is not None:
+            rate_columns = [col for col in rate_columns if col in currencies]
+
+        publication_dates = pd.to_datetime(currency_data[date_column_name]).dt.normalize()
+        rates = pd.DataFrame(currency_data[rate_columns].to_numpy(dtype=np.float64), columns=rate_columns,
+                             index=publication_dates.to_numpy())
+        rates = rates[~rates.index.duplicated(keep='last')].sort_index().ffill()
+        # before the first day on which every currency has a rate there is nothing to carry forward
+        complete_days = rates.index[rates.notna().all(axis=1).to_numpy()]
+        if complete_days.empty:
+            raise ValueError(f"the currencies {[col for col in rate_columns if rates[col].isna().all()]} have no "
+                             f"rate of base {base_currency}, there is no day to build the cross rate cube from")
+        calendar = pd.date_range(complete_days[0], rates.index[-1], freq='D')
+        rates = rates.reindex(calendar).ffill()
+
+        # the base currency buys one unit of itself
+        base_rates = np.empty((len(calendar), len(rate_columns) + 1), dtype=np.float64)
+        base_rates[:, 0] = 1.0
+        base_rates[:, 1:] = rates.to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cube = base_rates[:, np.newaxis, :] / base_rates[:, :, np.newaxis]
+        return cls(first_date=calendar[0].to_datetime64(), currencies=[base_currency] + rate_columns, cube=cube)
+
+    @property
+    def last_date(self):
+        return self.first_date + np.timedelta64(len(self.cube) - 1, 'D')
+
+    def currency_index(self, currencies) -> np.ndarray:
+        """
+        Returns the positions of currency codes on the currency axes of the cube.
+
+        Raises:
+            ValueError: If a currency is not in the cube.
+        """
+        if isinstance(currencies, (pd.Series, pd.Categorical)) and isinstance(currencies.dtype, pd.CategoricalDtype):
+            # a categorical column is mapped through its few categories instead of row by row
+            categorical = pd.Categorical(currencies)
+            unique_currencies, inverse = np.asarray(categorical.categories, dtype=object), categorical.codes
+            currencies = inverse
+        else:
+            currencies = np.asarray(currencies, dtype=object)
+            unique_currencies, inverse = np.unique(currencies, return_inverse=True)
+        missing = [currency for currency in unique_currencies if currency not in self.currency_indices]
+        if (np.asarray(inverse) < 0).any():
+            missing.append(None)
+        if missing:
+            raise ValueError(f"currencies {missing} are not in the cross rate cube, please select some of "
+                             f"{self.currencies}")
+        return np.array([self.currency_indices[currency] for currency in unique_currencies],
+                        dtype=np.intp)[inverse].reshape(currencies.shape)
+
+    def day_index(self, timestamps) -> np.ndarray:
+        """
+        Returns the positions of timestamps on the day axis of the cube. Timestamps before the first day
+        get the first day, timestamps after the last day get the last day.
+        """
+        days = np.asarray(timestamps, dtype='datetime64[ns]').astype('datetime64[D]')
+        return np.clip((days - self.first_date).astype(np.intp), 0, len(self.cube) - 1)
+
+    def lookup(self, from_currencies, to_currencies, timestamps) -> np.ndarray:
+        """
+        Looks up the cross rates of (from, to, timestamp) triples in one vectorized gather.
+
+        Args:
+            from_currencies (str or array-like): The currencies to convert from, one per timestamp or a
+                                                 single one for all of them.
+            to_currencies (str or array-like): The currencies to convert to, one per timestamp or a single
+                                               one for all of them.
+            timestamps (array-like): The timestamps to look up, as datetime64 values.
+
+        Returns:
+            np.ndarray: The float64 rate of every triple, how many units of `to` one unit of `from` buys.
+        """
+        day_indices = self.day_index(timestamps)
+        from_indices = self.currency_index(from_currencies)
+        to_indices = self.currency_index(to_currencies)
+        return self.cube[day_indices, from_indices, to_indices]
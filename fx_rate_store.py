@@ -0,0 +1,160 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from logger import Logger
+import logging
+import pandas as pd
+
+from date_intervals import merge_intervals, missing_intervals, to_date
+
+
+class FxRateStore:
+    def __init__(self, store_dir=None, latest_ttl_seconds=3600):
+        """
+        Initializes the FxRateStore class, a process wide store of exchange rates keyed by (base_currency, date).
+
+        Exchange rates do not depend on the ticker, so one store is shared by every ticker and job of
+        the process. For every base currency the store keeps the rate table and the date intervals
+        already fetched, so only the missing sub ranges are requested from the Frankfurter API.
+        When `store_dir` is given the tables are persisted as parquet files and reused by later runs.
+
+        Args:
+            store_dir (str, optional): Directory to persist the rates in, rates are kept in memory only if None.
+            latest_ttl_seconds (int): Number of seconds the `latest` rates are served before being fetched again.
+
+        Example:
+            fx_rate_store = FxRateStore(store_dir="cache/fx", latest_ttl_seconds=600)
+            rates = fx_rate_store.get_rates("USD", "2024-01-01", "2024-12-31", fetch_rates=handler.fetch_rates)
+        """
+        self.log = Logger(name=__name__, log_file="logs/app.log", level=logging.DEBUG).get_logger()
+        self.store_dir = store_dir
+        self.latest_ttl_seconds = latest_ttl_seconds
+        self._rates = {}
+        self._intervals = {}
+        self._latest = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        if self.store_dir:
+            os.makedirs(self.store_dir, exist_ok=True)
+
+    @classmethod
+    def from_configs(cls, configs):
+        """
+        Creates an FxRateStore from the `fx_*` values of the Configs class.
+        """
+        return cls(store_dir=configs.fx_store_dir or None, latest_ttl_seconds=configs.fx_latest_ttl_seconds)
+
+    def _lock(self, base_currency):
+        with self._locks_lock:
+            return self._locks.setdefault(base_currency, threading.Lock())
+
+    def _rates_path(self, base_currency, name='rates'):
+        return os.path.join(self.store_dir, f'{base_currency}_{name}.parquet')
+
+    def _intervals_path(self, base_currency):
+        return os.path.join(self.store_dir, f'{base_currency}_intervals.json')
+
+    def _load(self, base_currency):
+        if base_currency in self._rates:
+            return
+        self._rates[base_currency] = None
+        self._intervals[base_currency] = []
+        if self.store_dir and os.path.exists(self._intervals_path(base_currency)):
+            with open(self._intervals_path(base_currency)) as intervals_file:
+                self._intervals[base_currency] = [(to_date(start), to_date(end))
+                                                  for start, end in json.load(intervals_file)['intervals']]
+            if os.path.exists(self._rates_path(base_currency)):
+                self._rates[base_currency] = pd.read_parquet(self._rates_path(base_currency))
+
+    def _persist(self, base_currency):
+        if not self.store_dir:
+            return
+        if self._rates[base_currency] is not None:
+            self._rates[base_currency].to_parquet(self._rates_path(base_currency))
+        tmp_path = self._intervals_path(base_currency) + '.tmp'
+        with open(tmp_path, 'w') as intervals_file:
+            json.dump({'intervals': [[str(start), str(end)] for start, end in self._intervals[base_currency]]},
+                      intervals_file)
+        os.replace(tmp_path, self._intervals_path(base_currency))
+
+    def get_rates(self, base_currency, date_to_fetch_from, date_to_fetch_till, fetch_rates):
+        """
+        Returns the exchange rates of a base currency for a date range, fetching only what is not stored yet.
+
+        The returned table also holds the last rate published before `date_to_fetch_from`, if stored,
+        so that dates at the start of the range which are not publication days can still be converted.
+
+        Args:
+            base_currency (str): The base currency of the exchange rates (e.g., "USD").
+            date_to_fetch_from (str): The start date of the range (format: YYYY-MM-DD).
+            date_to_fetch_till (str): The end date of the range (format: YYYY-MM-DD).
+            fetch_rates (Callable[[date, date], pd.DataFrame]): Fetches the rates of a sub range, returns a
+                DataFrame with the dates (format: YYYY-MM-DD) as the index and the currencies as columns.
+
+        Returns:
+            pd.DataFrame: The exchange rates with the dates as the index and the currencies as columns, else None.
+        """
+        start = to_date(date_to_fetch_from)
+        end = to_date(date_to_fetch_till)
+
+        with self._lock(base_currency):
+            self._load(base_currency)
+            gaps = missing_intervals((start, end), self._intervals[base_currency])
+            for gap_from, gap_till in gaps:
+                fetched_rates = fetch_rates(gap_from, gap_till)
+                if fetched_rates is None:
+                    continue
+                self._add_rates(base_currency, fetched_rates, gap_from, gap_till)
+            if gaps:
+                self._persist(base_currency)
+                self.log.debug(f"fetched {len(gaps)} missing date ranges of {base_currency} exchange rates")
+            rates = self._rates[base_currency]
+
+        if rates is None:
+            return None
+        first_date = rates.index.searchsorted(str(start), side='right') - 1
+        return rates.iloc[max(first_date, 0):rates.index.searchsorted(str(end), side='right')]
+
+    def _add_rates(self, base_currency, fetched_rates, date_to_fetch_from, date_to_fetch_till):
+        stored_rates = self._rates[base_currency]
+        rates = fetched_rates if stored_rates is None else pd.concat([stored_rates, fetched_rates])
+        rates = rates[~rates.index.duplicated(keep='last')].sort_index()
+        self._rates[base_currency] = rates
+
+        # today's rates may not be published yet, so today is never recorded as stored
+        end = min(date_to_fetch_till, datetime.now().date() - timedelta(days=1))
+        if date_to_fetch_from <= end:
+            self._intervals[base_currency] = merge_intervals(self._intervals[base_currency] +
+                                                             [(date_to_fetch_from, end)])
+
+    def get_latest(self, base_currency, fetch_latest):
+        """
+        Returns the latest exchange rates of a base currency, fetching them again once they are older than the TTL.
+
+        Args:
+            base_currency (str): The base currency of the exchange rates (e.g., "USD").
+            fetch_latest (Callable[[], pd.DataFrame]): Fetches the latest rates, returns a one row DataFrame
+                with the date as the index and the currencies as columns.
+
+        Returns:
+            pd.DataFrame: The latest exchange rates, else None.
+        """
+        with self._lock(base_currency):
+            fetched_at, rates = self._latest.get(base_currency, (None, None))
+            if fetched_at is None and self.store_dir and os.path.exists(self._rates_path(base_currency, 'latest')):
+                fetched_at = os.path.getmtime(self._rates_path(base_currency, 'latest'))
+                rates = pd.read_parquet(self._rates_path(base_currency, 'latest'))
+
+            if fetched_at is None or time.time() - fetched_at > self.latest_ttl_seconds:
+                rates = fetch_latest()
+                if rates is None:
+                    return None
+                fetched_at = time.time()
+                if self.store_dir:
+                    rates.to_parquet(self._rates_path(base_currency, 'latest'))
+            self._latest[base_currency] = (fetched_at, rates)
+
+        return rates
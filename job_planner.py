@@ -0,0 +1,317 @@
+import json
+import os
+import sys
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple
+
+from logger import Logger
+import logging
+import pandas as pd
+from dotenv import load_dotenv
+
+from bar_cache import BarCache
+from config_handler import Configs
+from currency_convertor import convert_currency_to_many, convert_currency_with_cross_rates, get_currency_column
+from database_writer import DatabaseWriter
+from date_intervals import merge_intervals, to_date
+from frankfurter_api_handler import FrankfurterApiHandler
+from fx_cross_rates import CrossRateCube
+from fx_rate_store import FxRateStore
+from polygon_api_handler import PolygonApiHandler
+from request_scheduler import RequestScheduler
+
+load_dotenv()
+
+
+class Job(NamedTuple):
+    ticker: str
+    time_frame: str
+    date_to_fetch_from: str
+    date_to_fetch_till: str
+    currency_to_convert_to: str
+    base_currency: str = 'USD'
+    number_of_time_frames: str = '1'
+    adjusted: str = 'true'
+    stock_price_column_to_convert: tuple = ('o', 'c', 'h', 'l', 'vw')
+
+    @property
+    def polygon_key(self):
+        return self.ticker, self.number_of_time_frames, self.time_frame, self.adjusted
+
+
+def load_manifest(manifest_path):
+    """
+    Loads the jobs of a JSON or YAML manifest.
+
+    The manifest holds a `jobs` list and optional `defaults` applied to every job, a job may list several
+    tickers or target currencies, which expands into one job per combination:
+
+        defaults:
+          date_to_fetch_from: "2024-01-01"
+          date_to_fetch_till: "2024-12-31"
+          base_currency: USD
+        jobs:
+          - ticker: [AAPL, MSFT]
+            time_frame: day
+            currency_to_convert_to: [EUR, ILS]
+
+    Args:
+        manifest_path (str): Path of the manifest, read as YAML if it ends with .yaml or .yml.
+
+    Returns:
+        List[Job]: The jobs of the manifest.
+    """
+    with open(manifest_path) as manifest_file:
+        if manifest_path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError as e:
+                raise ImportError("YAML manifests require the pyyaml package, please install it") from e
+            manifest = yaml.safe_load(manifest_file)
+        else:
+            manifest = json.load(manifest_file)
+
+    jobs = []
+    for job_values in manifest['jobs']:
+        job_values = {**manifest.get('defaults', {}), **job_values}
+        tickers = job_values.pop('ticker')
+        currencies = job_values.pop('currency_to_convert_to')
+        if 'stock_price_column_to_convert' in job_values:
+            job_values['stock_price_column_to_convert'] = tuple(job_values['stock_price_column_to_convert'])
+        # YAML reads `adjusted: true` as a boolean, which has to match the "true" of the Polygon URL and keys
+        job_values = {key: value if key == 'stock_price_column_to_convert'
+                      else str(value).lower() if isinstance(value, bool) else str(value)
+                      for key, value in job_values.items()}
+        for ticker in tickers if isinstance(tickers, list) else [tickers]:
+            for currency in currencies if isinstance(currencies, list) else [currencies]:
+                jobs.append(Job(ticker=ticker, currency_to_convert_to=currency, **job_values))
+    return jobs
+
+
+class FetchPlan(NamedTuple):
+    polygon_requests: dict
+    frankfurter_requests: dict
+
+
+class JobPlanner:
+    def __init__(self, jobs: List[Job], request_scheduler, rate_store, database_writer, api_key,
+                 date_column_name='Date', max_workers=8, bar_cache=None):
+        """
+        Initializes the JobPlanner class, which runs many ticker/time_frame/currency jobs with the smallest
+        set of API calls.
+
+        Jobs which differ only in their target currency share their Polygon calls, overlapping and adjacent
+        date ranges of the same (ticker, multiplier, time_frame, adjusted) are coalesced into one range, and
+        the exchange rates are fetched with one Frankfurter range in the most common base currency of the jobs.
+        The jobs priced in another base currency are converted with a `CrossRateCube` triangulated through
+        the fetched base, so one download serves every base currency. The fetched data is then fanned back
+        out: every job gets the bars of its own date range converted into its own currency and written into
+        the stock price table of its time frame.
+
+        Args:
+            jobs (List[Job]): The jobs to run, see `load_manifest`.
+            request_scheduler (RequestScheduler): The scheduler all API requests are sent through.
+            rate_store (FxRateStore): The store of exchange rates.
+            database_writer (DatabaseWriter): The writer of the stock price and currency tables.
+            api_key (str): The API key for authenticating with the Polygon API.
+            date_column_name (str): The name of the date column in the fetched DataFrames.
+            max_workers (int): Maximum number of requests executed concurrently.
+            bar_cache (BarCache, optional): Local cache of bars.
+
+        Example:
+            job_planner = JobPlanner(jobs=load_manifest("jobs.yaml"), request_scheduler=request_scheduler,
+                                     rate_store=FxRateStore(), database_writer=database_writer,
+                                     api_key=configs.api_key)
+            errors = job_planner.run()
+        """
+        self.log = Logger(name=__name__, log_file="logs/app.log", level=logging.DEBUG).get_logger()
+        self.jobs = list(dict.fromkeys(jobs))
+        self.request_scheduler = request_scheduler
+        self.rate_store = rate_store
+        self.database_writer = database_writer
+        self.api_key = api_key
+        self.date_column_name = date_column_name
+        self.max_workers = max_workers
+        self.bar_cache = bar_cache
+
+    def plan(self):
+        """
+        Merges the jobs into the smallest set of API calls.
+
+        Returns:
+            FetchPlan: The merged date ranges per (ticker, multiplier, time_frame, adjusted) to request from
+                       Polygon and the single date range, in the most common base currency of the jobs, to
+                       request from Frankfurter.
+        """
+        polygon_intervals = defaultdict(list)
+        frankfurter_intervals = []
+        for job in self.jobs:
+            interval = (to_date(job.date_to_fetch_from), to_date(job.date_to_fetch_till))
+            polygon_intervals[job.polygon_key].append(interval)
+            frankfurter_intervals.append(interval)
+
+        frankfurter_requests = {}
+        if self.jobs:
+            base_currency = Counter(job.base_currency for job in self.jobs).most_common(1)[0][0]
+            frankfurter_requests[base_currency] = (min(start for start, _ in frankfurter_intervals),
+                                                   max(end for _, end in frankfurter_intervals))
+        fetch_plan = FetchPlan(
+            polygon_requests={key: merge_intervals(intervals) for key, intervals in polygon_intervals.items()},
+            frankfurter_requests=frankfurter_requests)
+        self.log.info(f"planned {sum(len(intervals) for intervals in fetch_plan.polygon_requests.values())} "
+                      f"polygon ranges and {len(fetch_plan.frankfurter_requests)} frankfurter ranges "
+                      f"for {len(self.jobs)} jobs")
+        return fetch_plan
+
+    def _fetch_bars(self, polygon_key, date_to_fetch_from, date_to_fetch_till):
+        ticker, number_of_time_frames, time_frame, adjusted = polygon_key
+        return PolygonApiHandler(ticker=ticker, date_to_fetch_from=date_to_fetch_from,
+                                 date_to_fetch_till=date_to_fetch_till, number_of_time_frames=number_of_time_frames,
+                                 time_frame=time_frame, adjusted=adjusted, sort='asc', api_key=self.api_key,
+                                 date_column_name=self.date_column_name, latest=False,
+                                 request_scheduler=self.request_scheduler,
+                                 bar_cache=self.bar_cache).get_polygon_data()
+
+    def _fetch_rates(self, base_currency, date_to_fetch_from, date_to_fetch_till):
+        return FrankfurterApiHandler(ticker=base_currency, date_to_fetch_from=date_to_fetch_from,
+                                     date_to_fetch_till=date_to_fetch_till, base_currency=base_currency,
+                                     date_column_name=self.date_column_name, latest=False,
+                                     request_scheduler=self.request_scheduler,
+                                     rate_store=self.rate_store).get_frankfurter_data()
+
+    def fetch(self, fetch_plan):
+        """
+        Executes the API calls of a plan concurrently.
+
+        Returns:
+            Dict[tuple, pd.DataFrame]: The bars per (ticker, multiplier, time_frame, adjusted).
+            Dict[str, pd.DataFrame]: The exchange rates per base currency.
+            Dict[tuple, str]: The error message per failed (ticker, multiplier, time_frame, adjusted).
+        """
+        bars, rates, errors = {}, {}, {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            rate_futures = {base_currency: executor.submit(self._fetch_rates, base_currency, *interval)
+                            for base_currency, interval in fetch_plan.frankfurter_requests.items()}
+            bar_futures = {polygon_key: [executor.submit(self._fetch_bars, polygon_key, *interval)
+                                         for interval in intervals]
+                           for polygon_key, intervals in fetch_plan.polygon_requests.items()}
+
+            for polygon_key, futures in bar_futures.items():
+                try:
+                    frames = [future.result() for future in futures]
+                    frames = [frame for frame in frames if frame is not None]
+                    bars[polygon_key] = pd.concat(frames, ignore_index=True) if frames else None
+                except Exception as e:
+                    errors[polygon_key] = str(e)
+                    self.log.error(f"failed to fetch bars of {polygon_key}: {e}")
+            for base_currency, future in rate_futures.items():
+                try:
+                    rates[base_currency] = future.result()
+                except Exception as e:
+                    rates[base_currency] = None
+                    self.log.error(f"failed to fetch {base_currency} exchange rates: {e}")
+        return bars, rates, errors
+
+    def fan_out(self, bars, rates):
+        """
+        Converts the fetched bars of every job into its currency and writes them to its time frame table.
+        Jobs sharing their bars, date range and columns are converted together in one pass, the jobs priced
+        in another base currency than the fetched rates are converted with the cross rates of the fetched base.
+        """
+        job_currencies = {currency for job in self.jobs for currency in (job.base_currency, job.currency_to_convert_to)}
+        # only the currencies of the jobs, so a currency published later does not move the first day of the cube
+        cross_rate_cubes = {fx_base_currency: CrossRateCube.from_currency_data(currency_data, self.date_column_name,
+                                                                               base_currency=fx_base_currency,
+                                                                               currencies=job_currencies)
+                            for fx_base_currency, currency_data in rates.items()
+                            if currency_data is not None and not currency_data.empty}
+        job_groups = defaultdict(list)
+        for job in self.jobs:
+            job_groups[(job.polygon_key, job.base_currency, job.date_to_fetch_from, job.date_to_fetch_till,
+                        job.stock_price_column_to_convert)].append(job.currency_to_convert_to)
+
+        for (polygon_key, base_currency, date_to_fetch_from, date_to_fetch_till, columns), currencies \
+                in job_groups.items():
+            stock_price_data = bars.get(polygon_key)
+            if stock_price_data is None or stock_price_data.empty:
+                continue
+            bar_dates = stock_price_data[self.date_column_name]
+            stock_price_data = stock_price_data[(bar_dates >= pd.Timestamp(to_date(date_to_fetch_from))) &
+                                                (bar_dates <= pd.Timestamp(to_date(date_to_fetch_till)))]
+            stock_price_data = stock_price_data.reset_index(drop=True)
+            if stock_price_data.empty:
+                continue
+
+            columns = [col for col in columns if col in stock_price_data.columns]
+            adjusted_stock_price_data = {}
+            if base_currency in rates:
+                currency_data = rates[base_currency]
+                convertible = [currency for currency in currencies
+                               if currency_data is not None and currency in currency_data.columns]
+                if convertible:
+                    adjusted_stock_price_data, _ = convert_currency_to_many(stock_price_data=stock_price_data,
+                                                                            currency_data=currency_data,
+                                                                            date_column_name=self.date_column_name,
+                                                                            stock_price_column_to_convert=columns,
+                                                                            currencies_to_convert_to=convertible)
+            else:
+                cross_rate_cube = next(iter(cross_rate_cubes.values()), None)
+                convertible = [currency for currency in currencies if cross_rate_cube is not None and
+                               {currency, base_currency} <= set(cross_rate_cube.currencies)]
+                for currency in convertible:
+                    adjusted_stock_price_data[currency], _ = convert_currency_with_cross_rates(
+                        stock_price_data=stock_price_data.copy(),
+                        cross_rate_cube=cross_rate_cube,
+                        date_column_name=self.date_column_name,
+                        stock_price_column_to_convert=columns,
+                        currency_to_convert_to=currency,
+                        currency_to_convert_from=base_currency)
+            if len(convertible) < len(currencies):
+                self.log.debug(f"currencies {sorted(set(currencies) - set(convertible))} are invalid for "
+                               f"{polygon_key}, leaving the currency as {base_currency}")
+                adjusted_stock_price_data[base_currency] = stock_price_data.assign(
+                    currency=get_currency_column(base_currency, len(stock_price_data)))
+
+            for adjusted_data in adjusted_stock_price_data.values():
+                self.database_writer.write_stock_price_data(adjusted_data, time_frame=polygon_key[2])
+
+        for base_currency, currency_data in rates.items():
+            if currency_data is not None:
+                rates_to_store = currency_data.drop(self.date_column_name, axis=1)
+                rates_to_store['timestamp'] = pd.to_datetime(currency_data[self.date_column_name])
+                self.database_writer.write_currency_data(rates_to_store)
+
+    def run(self):
+        """
+        Plans, fetches and fans out all jobs.
+
+        Returns:
+            Dict[tuple, str]: The error message per failed (ticker, multiplier, time_frame, adjusted).
+        """
+        bars, rates, errors = self.fetch(self.plan())
+        self.fan_out(bars, rates)
+        return errors
+
+
+if __name__ == '__main__':
+    configs = Configs()
+    manifest_path = sys.argv[1] if len(sys.argv) > 1 else os.getenv('manifest_path')
+    database_writer = DatabaseWriter.from_configs(configs)
+    job_planner = JobPlanner(jobs=load_manifest(manifest_path),
+                             request_scheduler=RequestScheduler.from_configs(configs),
+                             rate_store=FxRateStore.from_configs(configs),
+                             database_writer=database_writer,
+                             api_key=configs.api_key,
+                             date_column_name=configs.date_column_name,
+                             max_workers=configs.max_workers,
+                             bar_cache=BarCache(cache_dir=configs.bar_cache_dir,
+                                                market_timezone=configs.market_timezone)
+                             if configs.bar_cache_dir else None)
+    try:
+        errors = job_planner.run()
+    finally:
+        database_writer.close()
+    if errors:
+        job_planner.log.error(f"failed to fetch {list(errors.keys())}")
+        sys.exit(1)
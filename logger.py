@@ -1,6 +1,47 @@
+import atexit
+import itertools
+import json
 import logging
 import logging.handlers
 import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from operator import itemgetter
+
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
+def _get_log_queue(log_file, formatter):
+    """
+    Returns the queue of a log file, starting its background listener on first use.
+    One listener per log file writes the records to the console and to the file, so every record
+    is formatted and written once no matter how many Logger objects share the file.
+    """
+    with _listeners_lock:
+        if log_file not in _listeners:
+            handlers = [logging.StreamHandler()]
+            if log_file:
+                os.makedirs(os.path.dirname(log_file), exist_ok=True)
+                handlers.append(logging.FileHandler(log_file))
+            for handler in handlers:
+                handler.setFormatter(formatter)
+            log_queue = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+            listener.start()
+            _listeners[log_file] = (log_queue, listener)
+        return _listeners[log_file][0]
+
+
+@atexit.register
+def _stop_listeners():
+    with _listeners_lock:
+        for _, listener in _listeners.values():
+            listener.stop()
+        _listeners.clear()
 
 
 class Logger:
@@ -8,6 +49,10 @@ class Logger:
         """
         Initialize the Logger.
 
+        Records are put on a queue and written to the console and the log file by a background
+        listener, so callers never block on I/O. Handlers are attached once per logger name,
+        constructing the Logger again for the same name only updates its level.
+
         :param name: Logger name (usually __name__).
         :param log_file: Optional file path to log to.
         :param level: Logging level (e.g., logging.INFO, logging.DEBUG).
@@ -16,24 +61,17 @@ class Logger:
         self.logger = logging.getLogger(name)
         self.logger.setLevel(level)
 
-        formatter = logging.Formatter(
-            '[%(asctime)s] [%(levelname)s] %(name)s: %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
-        )
+        if not getattr(self.logger, '_queue_handler_attached', False):
+            formatter = logging.Formatter(
+                '[%(asctime)s] [%(levelname)s] %(name)s: %(message)s',
+                datefmt='%Y-%m-%d %H:%M:%S'
+            )
+            self.logger.addHandler(logging.handlers.QueueHandler(_get_log_queue(log_file, formatter)))
+            self.logger.propagate = False
+            self.logger._queue_handler_attached = True
 
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(formatter)
-        self.logger.addHandler(console_handler)
-
-        # Optional file handler
-        if log_file:
-            os.makedirs(os.path.dirname(log_file), exist_ok=True)
-            file_handler = logging.FileHandler(log_file)
-            file_handler.setFormatter(formatter)
-            self.logger.addHandler(file_handler)
-
-        if cloud_log:
-            self._add_cloud_vendor_handler()
+            if cloud_log:
+                self._add_cloud_vendor_handler()
 
     def get_logger(self):
         return self.logger
@@ -51,3 +89,140 @@ class Logger:
             self.logger.info("Cloud Logging handler initialized.")
         except Exception as e:
             self.logger.error(f"Failed to initialize Cloud Logging: {e}")
+
+
+class Metrics:
+    def __init__(self):
+        """
+        Thread safe registry of the pipeline metrics.
+
+        Counters (e.g. requests, retries, bytes, rows) are summed and durations (e.g. per stage) are
+        kept as count, sum and max. Every metric may carry labels. The registry can be exported as a
+        Prometheus text snapshot or as a JSON file at the end of a run.
+
+        Example:
+            metrics.increment('api_requests_total', api='api.polygon.io')
+            with metrics.span('currency_conversion'):
+                convert_currency_in_stock_price_df(...)
+            metrics.export('logs/metrics.prom')
+        """
+        self._counters = {}
+        self._durations = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            count, total, maximum = self._durations.get(key, (0, 0.0, 0.0))
+            self._durations[key] = (count + 1, total + seconds, max(maximum, seconds))
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """
+        Times the enclosed block into the `stage_duration_seconds` metric of the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_duration_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+    def timer(self, stage, **labels):
+        """
+        Decorator timing every call of the decorated function into the `stage_duration_seconds` metric.
+        """
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(stage, **labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self, reset=False):
+        """
+        Returns all metrics as a JSON serializable dictionary, and clears them when `reset` is True so
+        a worker process can hand over what it recorded since its last snapshot.
+        """
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            durations = [{'name': name, 'labels': dict(labels), 'count': count, 'sum': total, 'max': maximum}
+                         for (name, labels), (count, total, maximum) in sorted(self._durations.items())]
+            if reset:
+                self._counters.clear()
+                self._durations.clear()
+        return {'counters': counters, 'durations': durations}
+
+    def merge(self, snapshot):
+        """
+        Adds the metrics of a `snapshot` of another registry, e.g. of a worker process, to this registry.
+        """
+        with self._lock:
+            for counter in snapshot['counters']:
+                key = self._key(counter['name'], counter['labels'])
+                self._counters[key] = self._counters.get(key, 0) + counter['value']
+            for duration in snapshot['durations']:
+                key = self._key(duration['name'], duration['labels'])
+                count, total, maximum = self._durations.get(key, (0, 0.0, 0.0))
+                self._durations[key] = (count + duration['count'], total + duration['sum'],
+                                        max(maximum, duration['max']))
+
+    def to_prometheus(self):
+        """
+        Returns all metrics in the Prometheus text exposition format.
+
+        Counters are typed as counter and durations as summary (`_count` and `_sum`), their maximum is a
+        separate `_max` gauge family. Label values are escaped as the format requires.
+        """
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        def series(name, labels):
+            label_text = ','.join(f'{key}="{escape(value)}"' for key, value in labels.items())
+            return f'{name}{{{label_text}}}' if label_text else name
+
+        snapshot = self.snapshot()
+        lines = []
+        # the snapshot is sorted by name, so the series of a metric family are contiguous
+        for name, counters in itertools.groupby(snapshot['counters'], key=itemgetter('name')):
+            lines.append(f'# TYPE {name} counter')
+            lines.extend(f"{series(name, counter['labels'])} {counter['value']}" for counter in counters)
+        for name, durations in itertools.groupby(snapshot['durations'], key=itemgetter('name')):
+            durations = list(durations)
+            lines.append(f'# TYPE {name} summary')
+            for duration in durations:
+                lines.append(f"{series(name + '_count', duration['labels'])} {duration['count']}")
+                lines.append(f"{series(name + '_sum', duration['labels'])} {duration['sum']}")
+            lines.append(f'# TYPE {name}_max gauge')
+            lines.extend(f"{series(name + '_max', duration['labels'])} {duration['max']}" for duration in durations)
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """
+        Writes the metrics to a file, as JSON if the path ends with .json and as Prometheus text otherwise.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as metrics_file:
+            if path.endswith('.json'):
+                json.dump(self.snapshot(), metrics_file, indent=2)
+            else:
+                metrics_file.write(self.to_prometheus())
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._durations.clear()
+
+
+metrics = Metrics()
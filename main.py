@@ -1,9 +1,15 @@
 import logging
-from logger import Logger
-
-from frankfurter_api_handler import FrankfurterApiHandler
-from polygon_api_handler import PolygonApiHandler
-from currency_convertor import convert_currency_in_stock_price_df
+from logger import Logger, metrics
+import pandas as pd
+
+from batch_fetcher import BatchFetcher
+from bar_cache import BarCache
+from fx_rate_store import FxRateStore
+from database_writer import DatabaseWriter
+from columnar_sink import ColumnarSink
+from request_scheduler import RequestScheduler
+from currency_convertor import convert_currency_in_stock_price_df, get_currency_column
+from resampler import check_resample_time_frames, get_bucket_range, resample_bars
 from config_handler import Configs
 
 from dotenv import load_dotenv
@@ -13,66 +19,104 @@ load_dotenv()
 log = Logger(name=__name__, log_file="logs/app.log", level=logging.DEBUG).get_logger()
 
 configs = Configs()
-
-frankfurter_handler = FrankfurterApiHandler(base_currency=configs.base_currency,
-                                            date_to_fetch_from=configs.date_to_fetch_from,
-                                            date_to_fetch_till=configs.date_to_fetch_till,
-                                            ticker=configs.ticker,
-                                            date_column_name=configs.date_column_name,
-                                            latest=configs.latest)
-
-currency_data = frankfurter_handler.get_frankfurter_data()
-
-polygon_api_handler = PolygonApiHandler(date_to_fetch_from=configs.date_to_fetch_from,
-                                        date_to_fetch_till=configs.date_to_fetch_till,
-                                        ticker=configs.ticker,
-                                        time_frame=configs.time_frame,
-                                        adjusted=configs.adjusted,
-                                        number_of_time_frames=configs.number_of_time_frames,
-                                        date_column_name=configs.date_column_name,
-                                        sort=configs.sort, api_key=configs.api_key, latest=configs.latest)
-
-stock_price_data = polygon_api_handler.get_polygon_data()
+check_resample_time_frames(configs.time_frame, configs.resample_time_frames)
+
+bar_cache = BarCache(cache_dir=configs.bar_cache_dir, market_timezone=configs.market_timezone) \
+    if configs.bar_cache_dir else None
+request_scheduler = RequestScheduler.from_configs(configs)
+fx_rate_store = FxRateStore.from_configs(configs)
+
+batch_fetcher = BatchFetcher(tickers=configs.tickers,
+                             date_to_fetch_from=configs.date_to_fetch_from,
+                             date_to_fetch_till=configs.date_to_fetch_till,
+                             number_of_time_frames=configs.number_of_time_frames,
+                             time_frame=configs.time_frame,
+                             adjusted=configs.adjusted,
+                             sort=configs.sort,
+                             api_key=configs.api_key,
+                             date_column_name=configs.date_column_name,
+                             latest=configs.latest,
+                             base_currency=configs.base_currency,
+                             max_workers=configs.max_workers,
+                             bar_cache=bar_cache,
+                             rate_store=fx_rate_store,
+                             request_scheduler=request_scheduler)
+
+currency_data, stock_price_data_per_ticker, errors = batch_fetcher.fetch()
+
+if errors:
+    log.error(f"failed to fetch tickers {list(errors.keys())}, continuing with the rest")
 
 convertion_is_valid = True
 
-if configs.currency_to_convert_to not in currency_data.columns:
-    convertion_is_valid = False
-    log.debug(f"currency to convert {configs.currency_to_convert_to} is invalid leaving the currency as {configs.base_currency}")
-
-for col in configs.stock_price_column_to_convert:
-    if col not in stock_price_data.columns:
-        log.debug(
-            f"column {col}, being removed from stock_price_column_to_convert because it is not in stock_price_data "
-            f"columns to convert based on selected currency please select one of"
-            f"{str(stock_price_data.columns)}")
-        configs.stock_price_column_to_convert.remove(col)
-
-
-if stock_price_data is not None and currency_data is None:
+if currency_data is None:
     convertion_is_valid = False
     log.debug(f"only have stock price data and not currency data so will save currency base on USD")
+elif configs.currency_to_convert_to not in currency_data.columns:
+    convertion_is_valid = False
+    log.debug(f"currency to convert {configs.currency_to_convert_to} is invalid leaving the currency as {configs.base_currency}")
 
-if convertion_is_valid:
-    stock_price_data, timestamp = convert_currency_in_stock_price_df(stock_price_data=stock_price_data,
-                                                            latest=configs.latest,
-                                                            currency_data=currency_data,
-                                                            currency_to_convert_to=configs.currency_to_convert_to,
-                                                            date_column_name=configs.date_column_name,
-                                                            stock_price_column_to_convert=configs.stock_price_column_to_convert)
-    currency_data['timestamp'] = timestamp
-    currency_data.drop('Date', axis=1, inplace=True)
-else:
-    stock_price_data['currency'] = configs.base_currency
+timestamp = None
+for ticker, stock_price_data in stock_price_data_per_ticker.items():
+    if stock_price_data is None:
+        log.debug(f"no stock price data for ticker {ticker} in the requested range")
+        continue
+    for col in list(configs.stock_price_column_to_convert):
+        if col not in stock_price_data.columns:
+            log.debug(
+                f"column {col}, being removed from stock_price_column_to_convert because it is not in stock_price_data "
+                f"columns to convert based on selected currency please select one of"
+                f"{str(stock_price_data.columns)}")
+            configs.stock_price_column_to_convert.remove(col)
+
+    if convertion_is_valid:
+        stock_price_data, ticker_timestamp = convert_currency_in_stock_price_df(stock_price_data=stock_price_data,
+                                                                       latest=configs.latest,
+                                                                       currency_data=currency_data,
+                                                                       currency_to_convert_to=configs.currency_to_convert_to,
+                                                                       date_column_name=configs.date_column_name,
+                                                                       stock_price_column_to_convert=configs.stock_price_column_to_convert)
+        timestamp = ticker_timestamp if timestamp is None else max(timestamp, ticker_timestamp)
+    else:
+        stock_price_data['currency'] = get_currency_column(configs.base_currency, len(stock_price_data))
+    stock_price_data_per_ticker[ticker] = stock_price_data
+
+if currency_data is not None:
+    currency_data['timestamp'] = timestamp if configs.latest and timestamp is not None \
+        else pd.to_datetime(currency_data[configs.date_column_name])
+    currency_data.drop(configs.date_column_name, axis=1, inplace=True)
+
+stock_price_data = BatchFetcher.combine_frames(stock_price_data_per_ticker)
 
 log.info(f"successfully created object stock_price_data ready to insert to DB")
 
-# insert to database table based on 'time_frame' value table
-
-# final_stock_price_data(['v', 'vw', 'o', 'c', 'h', 'l', 't', 'n', 'timestamp', 'ticker'], dtype='object')
-
-# currency_data(['AUD', 'BGN', 'BRL', 'CAD', 'CHF', 'CNY', 'CZK', 'DKK', 'EUR', 'GBP',
-#        'HKD', 'HUF', 'IDR', 'ILS', 'INR', 'ISK', 'JPY', 'KRW', 'MXN', 'MYR',
-#        'NOK', 'NZD', 'PHP', 'PLN', 'RON', 'SEK', 'SGD', 'THB', 'TRY', 'ZAR',
-#        'base_currency', 'timestamp'],
-#       dtype='object')
+database_writer = DatabaseWriter.from_configs(configs)
+database_writer.write_stock_price_data(stock_price_data, time_frame=configs.time_frame)
+if stock_price_data is not None and not stock_price_data.empty:
+    tickers = stock_price_data['ticker'].unique().tolist()
+    currencies = stock_price_data['currency'].unique().tolist()
+    for time_frame in configs.resample_time_frames:
+        # the fetched bars may cover their coarser buckets only partly (e.g. with latest=1), so every bucket
+        # they touch is rolled up again from all of its stored bars instead of replacing it with a partial bar
+        timestamp_from, timestamp_till = get_bucket_range(stock_price_data['timestamp'], time_frame,
+                                                          timezone=configs.market_timezone)
+        stored_stock_price_data = database_writer.read_stock_price_data(configs.time_frame, tickers, currencies,
+                                                                        timestamp_from, timestamp_till)
+        database_writer.write_stock_price_data(resample_bars(stored_stock_price_data,
+                                                             time_frame=time_frame,
+                                                             timezone=configs.market_timezone,
+                                                             session_start=configs.session_start,
+                                                             session_end=configs.session_end,
+                                                             date_column_name=configs.date_column_name),
+                                               time_frame=time_frame)
+database_writer.write_currency_data(currency_data)
+database_writer.close()
+
+if configs.columnar_dir:
+    columnar_sink = ColumnarSink.from_configs(configs)
+    columnar_sink.write_stock_price_data(stock_price_data, time_frame=configs.time_frame)
+    columnar_sink.write_currency_data(currency_data)
+    columnar_sink.compact()
+
+if configs.metrics_path:
+    metrics.export(configs.metrics_path)
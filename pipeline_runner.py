@@ -0,0 +1,328 @@
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import shared_memory
+
+from logger import Logger, metrics
+import logging
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+from columnar_sink import ColumnarSink
+from config_handler import Configs
+from currency_convertor import convert_currency_in_stock_price_df, get_currency_column
+from database_writer import DatabaseWriter
+from frankfurter_api_handler import FrankfurterApiHandler
+from fx_rate_store import FxRateStore
+from polygon_api_handler import PolygonApiHandler
+from request_scheduler import RequestScheduler
+
+load_dotenv()
+
+_END_OF_STREAM = None
+# the exchange rates attached by every worker process of the pool, see `_init_worker`
+_worker_fx_table = None
+# the handlers decoding the pages of every ticker in a worker process, they never send a request
+_worker_polygon_handlers = {}
+_worker_request_scheduler = None
+
+
+class SharedFxTable:
+    def __init__(self, shared_memory_block, number_of_dates, currencies, date_column_name, owner):
+        """
+        Exchange rates held in a shared memory block, so the worker processes of the pipeline read the same
+        pages instead of receiving a pickled copy of the rates with every chunk.
+
+        The block holds the publication dates as int64 nanoseconds followed by the (dates, currencies)
+        float64 matrix of the rates. `currency_data` wraps both arrays in a DataFrame without copying them.
+
+        Args:
+            shared_memory_block (shared_memory.SharedMemory): The block holding the rates.
+            number_of_dates (int): Number of publication dates.
+            currencies (List[str]): The currencies of the rate matrix.
+            date_column_name (str): The name of the date column of `currency_data`.
+            owner (bool): Whether this process created the block and unlinks it on `close`.
+
+        Example:
+            shared_fx_table = SharedFxTable.create(currency_data, "Date", ["EUR"])
+            with ProcessPoolExecutor(initializer=_init_worker, initargs=(shared_fx_table.descriptor,)):
+                ...
+            shared_fx_table.close()
+        """
+        self.shared_memory_block = shared_memory_block
+        self.number_of_dates = number_of_dates
+        self.currencies = currencies
+        self.date_column_name = date_column_name
+        self.owner = owner
+
+    @classmethod
+    def create(cls, currency_data, date_column_name, currencies):
+        dates = pd.to_datetime(currency_data[date_column_name]).to_numpy(dtype='datetime64[ns]').view(np.int64)
+        rates = currency_data[currencies].to_numpy(dtype=np.float64)
+        shared_memory_block = shared_memory.SharedMemory(create=True, size=max(dates.nbytes + rates.nbytes, 1))
+        shared_fx_table = cls(shared_memory_block, len(dates), list(currencies), date_column_name, owner=True)
+        shared_dates, shared_rates = shared_fx_table._arrays()
+        shared_dates[:] = dates
+        shared_rates[:] = rates
+        return shared_fx_table
+
+    @property
+    def descriptor(self):
+        return self.shared_memory_block.name, self.number_of_dates, self.currencies, self.date_column_name
+
+    @classmethod
+    def attach(cls, descriptor):
+        name, number_of_dates, currencies, date_column_name = descriptor
+        return cls(shared_memory.SharedMemory(name=name), number_of_dates, currencies, date_column_name, owner=False)
+
+    def _arrays(self):
+        dates = np.ndarray((self.number_of_dates,), dtype=np.int64, buffer=self.shared_memory_block.buf)
+        rates = np.ndarray((self.number_of_dates, len(self.currencies)), dtype=np.float64,
+                           buffer=self.shared_memory_block.buf, offset=dates.nbytes)
+        return dates, rates
+
+    def currency_data(self):
+        dates, rates = self._arrays()
+        currency_data = pd.DataFrame(rates, columns=self.currencies, copy=False)
+        currency_data[self.date_column_name] = dates.view('datetime64[ns]')
+        return currency_data
+
+    def close(self):
+        self.shared_memory_block.close()
+        if self.owner:
+            self.shared_memory_block.unlink()
+
+
+def _init_worker(descriptor):
+    global _worker_fx_table, _worker_request_scheduler
+    _worker_fx_table = SharedFxTable.attach(descriptor) if descriptor is not None else None
+    _worker_request_scheduler = RequestScheduler()
+
+
+def _convert_page(content, first_page, polygon_arguments, stock_price_column_to_convert, currency_to_convert_to,
+                  base_currency):
+    """
+    Decodes one page of bars and converts it in a worker process with the exchange rates attached to the process.
+
+    Returns:
+        Tuple[pd.DataFrame, dict]: The converted bars, None if the page holds no bars, and the snapshot of the
+                                   metrics recorded by the worker since its previous page.
+    """
+    ticker = polygon_arguments['ticker']
+    if ticker not in _worker_polygon_handlers:
+        _worker_polygon_handlers[ticker] = PolygonApiHandler(request_scheduler=_worker_request_scheduler,
+                                                             **polygon_arguments)
+    stock_price_data = _worker_polygon_handlers[ticker].decode_polygon_page(content, first_page=first_page)
+    date_column_name = polygon_arguments['date_column_name']
+    if stock_price_data is None:
+        pass
+    elif _worker_fx_table is None:
+        stock_price_data['currency'] = get_currency_column(base_currency, len(stock_price_data))
+        stock_price_data = stock_price_data.drop(date_column_name, axis=1, errors='ignore')
+    else:
+        columns_to_convert = [col for col in stock_price_column_to_convert if col in stock_price_data.columns]
+        stock_price_data, _ = convert_currency_in_stock_price_df(stock_price_data=stock_price_data,
+                                                                 latest=False,
+                                                                 currency_data=_worker_fx_table.currency_data(),
+                                                                 date_column_name=date_column_name,
+                                                                 stock_price_column_to_convert=columns_to_convert,
+                                                                 currency_to_convert_to=currency_to_convert_to)
+    return stock_price_data, metrics.snapshot(reset=True)
+
+
+class PipelineRunner:
+    def __init__(self, configs, request_scheduler, rate_store, sink, max_processes=None, queue_size=4,
+                 max_in_flight=None, chunk_rows=50000):
+        """
+        Initializes the PipelineRunner class, an out-of-core version of main.py which streams the bars
+        through the conversion into the sink chunk by chunk.
+
+        Fetcher threads only do I/O, they follow the Polygon pages of every ticker with `iter_polygon_pages`,
+        one page of at most `chunk_rows` bars being one chunk, and put the raw bytes on a bounded queue. The
+        chunks are decoded and converted on a process pool whose workers attach the exchange rates from shared
+        memory once, at start up, instead of receiving them with every chunk. The converted chunks are written
+        to the sink as they complete and the metrics recorded by the workers are merged into `metrics`.
+        The queue and the bounded number of chunks in flight on the pool apply backpressure to the fetchers,
+        so peak memory is set by the chunk size and not by the length of the history.
+
+        Args:
+            configs (Configs): The configuration of the run (tickers, dates, currencies, columns to convert, ...).
+            request_scheduler (RequestScheduler): The scheduler all API requests are sent through.
+            rate_store (FxRateStore): The store of exchange rates.
+            sink (DatabaseWriter or ColumnarSink): The output of the converted bars and the rates.
+            max_processes (int, optional): Number of conversion processes, the number of CPUs if not given.
+            queue_size (int): Maximum number of fetched chunks waiting for a conversion process.
+            max_in_flight (int, optional): Maximum number of chunks submitted to the pool and not yet written,
+                                           twice the number of processes if not given.
+            chunk_rows (int): Maximum number of bars per chunk, the Polygon page limit.
+
+        Example:
+            pipeline_runner = PipelineRunner.from_configs(Configs())
+            pipeline_runner.run()
+        """
+        self.log = Logger(name=__name__, log_file="logs/app.log", level=logging.DEBUG).get_logger()
+        self.configs = configs
+        self.request_scheduler = request_scheduler
+        self.rate_store = rate_store
+        self.sink = sink
+        self.max_processes = max_processes or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.max_in_flight = max_in_flight or 2 * self.max_processes
+        self.chunk_rows = chunk_rows
+        self._stop_event = threading.Event()
+
+    @classmethod
+    def from_configs(cls, configs):
+        """
+        Creates a PipelineRunner and its dependencies from the Configs class, the bars are written to the
+        columnar sink when `columnar_dir` is set and to the database otherwise.
+        """
+        sink = ColumnarSink.from_configs(configs) if configs.columnar_dir else DatabaseWriter.from_configs(configs)
+        return cls(configs=configs,
+                   request_scheduler=RequestScheduler.from_configs(configs),
+                   rate_store=FxRateStore.from_configs(configs),
+                   sink=sink,
+                   max_processes=configs.pipeline_processes or None,
+                   queue_size=configs.pipeline_queue_size,
+                   chunk_rows=configs.pipeline_chunk_rows)
+
+    def _get_currency_data(self):
+        frankfurter_handler = FrankfurterApiHandler(ticker=",".join(self.configs.tickers),
+                                                    date_to_fetch_from=self.configs.date_to_fetch_from,
+                                                    date_to_fetch_till=self.configs.date_to_fetch_till,
+                                                    base_currency=self.configs.base_currency,
+                                                    date_column_name=self.configs.date_column_name,
+                                                    latest=False,
+                                                    request_scheduler=self.request_scheduler,
+                                                    rate_store=self.rate_store)
+        return frankfurter_handler.get_frankfurter_data()
+
+    def _put(self, chunk_queue, item):
+        # waits for free room on the queue, giving up when the run is stopped
+        while not self._stop_event.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get_polygon_arguments(self, ticker):
+        return dict(ticker=ticker,
+                    date_to_fetch_from=self.configs.date_to_fetch_from,
+                    date_to_fetch_till=self.configs.date_to_fetch_till,
+                    number_of_time_frames=self.configs.number_of_time_frames,
+                    time_frame=self.configs.time_frame,
+                    adjusted=self.configs.adjusted,
+                    sort=self.configs.sort,
+                    api_key=self.configs.api_key,
+                    date_column_name=self.configs.date_column_name,
+                    latest=False,
+                    page_limit=self.chunk_rows)
+
+    def _fetch_ticker(self, ticker, chunk_queue):
+        polygon_arguments = self._get_polygon_arguments(ticker)
+        polygon_api_handler = PolygonApiHandler(request_scheduler=self.request_scheduler, **polygon_arguments)
+        for page_number, content in enumerate(polygon_api_handler.iter_polygon_pages()):
+            if not self._put(chunk_queue, (polygon_arguments, page_number == 0, content)):
+                return
+
+    def _produce(self, chunk_queue, errors):
+        with ThreadPoolExecutor(max_workers=self.configs.max_workers) as executor:
+            futures = {ticker: executor.submit(self._fetch_ticker, ticker, chunk_queue)
+                       for ticker in self.configs.tickers}
+        for ticker, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                errors[ticker] = str(e)
+                self.log.error(f"failed to fetch ticker {ticker}: {e}")
+        self._put(chunk_queue, _END_OF_STREAM)
+
+    def _write_completed(self, futures, return_when, errors):
+        done, _ = wait(futures, return_when=return_when)
+        for future in done:
+            ticker = futures.pop(future)
+            try:
+                stock_price_data, worker_metrics = future.result()
+            except Exception as e:
+                errors[ticker] = str(e)
+                self.log.error(f"failed to convert a page of ticker {ticker}: {e}")
+                continue
+            metrics.merge(worker_metrics)
+            if stock_price_data is None:
+                continue
+            with metrics.span('pipeline_write'):
+                self.sink.write_stock_price_data(stock_price_data, time_frame=self.configs.time_frame)
+            metrics.increment('rows_total', len(stock_price_data), stage='pipeline')
+
+    def run(self):
+        """
+        Runs the pipeline over all tickers of the configuration.
+
+        Returns:
+            Dict[str, str]: The error message per ticker which failed to fetch or convert.
+        """
+        currency_data = self._get_currency_data()
+        currency_to_convert_to = self.configs.currency_to_convert_to
+        if currency_data is None or currency_to_convert_to not in currency_data.columns:
+            self.log.debug(f"currency to convert {currency_to_convert_to} is invalid leaving the currency as "
+                           f"{self.configs.base_currency}")
+            shared_fx_table = None
+        else:
+            shared_fx_table = SharedFxTable.create(currency_data, self.configs.date_column_name,
+                                                   [currency_to_convert_to])
+
+        errors = {}
+        chunk_queue = queue.Queue(maxsize=self.queue_size)
+        producer = threading.Thread(target=self._produce, args=(chunk_queue, errors), daemon=True)
+        self._stop_event.clear()
+        try:
+            with ProcessPoolExecutor(max_workers=self.max_processes, initializer=_init_worker,
+                                     initargs=(shared_fx_table.descriptor if shared_fx_table else None,)) as executor:
+                producer.start()
+                futures = {}
+                while (chunk := chunk_queue.get()) is not _END_OF_STREAM:
+                    polygon_arguments, first_page, content = chunk
+                    future = executor.submit(_convert_page, content, first_page, polygon_arguments,
+                                             self.configs.stock_price_column_to_convert, currency_to_convert_to,
+                                             self.configs.base_currency)
+                    futures[future] = polygon_arguments['ticker']
+                    if len(futures) >= self.max_in_flight:
+                        self._write_completed(futures, FIRST_COMPLETED, errors)
+                if futures:
+                    self._write_completed(futures, ALL_COMPLETED, errors)
+        finally:
+            self._stop_event.set()
+            if producer.is_alive():
+                producer.join(timeout=5)
+            if shared_fx_table is not None:
+                shared_fx_table.close()
+
+        if currency_data is not None:
+            rates_to_store = currency_data.drop(self.configs.date_column_name, axis=1)
+            rates_to_store['timestamp'] = pd.to_datetime(currency_data[self.configs.date_column_name])
+            self.sink.write_currency_data(rates_to_store)
+        if hasattr(self.sink, 'compact'):
+            # merges the pages appended by this run with the bars of earlier runs
+            self.sink.compact()
+        self.log.info(f"pipeline finished for {len(self.configs.tickers)} tickers, {len(errors)} failed")
+        return errors
+
+
+if __name__ == '__main__':
+    configs = Configs()
+    pipeline_runner = PipelineRunner.from_configs(configs)
+    try:
+        errors = pipeline_runner.run()
+    finally:
+        if hasattr(pipeline_runner.sink, 'close'):
+            pipeline_runner.sink.close()
+        if configs.metrics_path:
+            metrics.export(configs.metrics_path)
+    if errors:
+        pipeline_runner.log.error(f"failed to fetch {list(errors.keys())}")
+        sys.exit(1)
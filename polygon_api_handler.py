@@ -1,19 +1,37 @@
-import sys
-
-import requests
 import os
 from datetime import datetime, timedelta
-from logger import Logger
+from logger import Logger, metrics
+from request_scheduler import RequestScheduler, get_polygon_rate_limit_key
+from json_decoder import decode_polygon_response, get_next_url
+from resampler import DAY_NANOSECONDS, get_local_nanoseconds
 import logging
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 
 load_dotenv()
 
+PRICE_COLUMNS = ['o', 'c', 'h', 'l', 'vw']
+
+
+def get_default_bar_dtypes():
+    """
+    Returns the dtypes of the numeric bar columns, the price and volume dtypes can be
+    overridden with the `polygon_price_dtype` and `polygon_volume_dtype` environment variables.
+    Prices are float64 by default, "float32" halves their memory but keeps only about 7 significant
+    digits, so it loses the cents of prices above about 100k and is stored as such by the sinks.
+    """
+    bar_dtypes = {column: os.getenv('polygon_price_dtype', 'float64') for column in PRICE_COLUMNS}
+    bar_dtypes['v'] = os.getenv('polygon_volume_dtype', 'float64')
+    bar_dtypes['n'] = 'int32'
+    bar_dtypes['t'] = 'int64'
+    return bar_dtypes
+
 
 class PolygonApiHandler:
     def __init__(self, ticker, date_to_fetch_from, date_to_fetch_till, number_of_time_frames, time_frame, adjusted,
-                 sort, api_key, date_column_name, latest):
+                 sort, api_key, date_column_name, latest, request_scheduler=None, page_limit=50000,
+                 bar_cache=None, bar_dtypes=None, market_timezone=None):
         """
         Initializes the PolygonApiHandler class with parameters necessary for
         fetching data from the Polygon API.
@@ -24,7 +42,8 @@ class PolygonApiHandler:
 
         Args:
             ticker (str): The stock ticker symbol to fetch data for.
-            date_to_fetch_from (str): The start date for the data to fetch (format: YYYY-MM-DD).
+            date_to_fetch_from (str): The start date for the data to fetch (format: YYYY-MM-DD), or the start
+                                      of the range as epoch milliseconds (int).
             date_to_fetch_till (str): The end date for the data to fetch (format: YYYY-MM-DD).
             number_of_time_frames (str): The number of time frames to fetch in string.
             time_frame (str): The time frame for the data (e.g., "day", "minute").
@@ -33,6 +52,16 @@ class PolygonApiHandler:
             api_key (str): The API key for authenticating with the Polygon API.
             date_column_name (str): The name of the date column in the resulting DataFrame.
             latest (bool): If True, fetch the latest data for the ticker; if False, fetch historical data.
+            request_scheduler (RequestScheduler, optional): Shared scheduler all requests are sent through, it rate
+                                                            limits, retries and reuses keep-alive connections across
+                                                            handlers. A new scheduler is created if not given.
+            page_limit (int): Maximum number of bars Polygon returns per page (the API allows up to 50000).
+            bar_cache (BarCache, optional): Local cache of bars, when given historical requests only fetch
+                                            the date ranges which are not cached yet.
+            bar_dtypes (dict, optional): dtype per numeric bar column, defaults to `get_default_bar_dtypes()`.
+            market_timezone (str, optional): The timezone of the exchange, the date column holds the trading day
+                                             of every bar in it. Defaults to the `market_timezone` environment
+                                             variable, or "America/New_York".
 
         Raises:
             ValueError: If the API key is not provided in the environment or as a parameter.
@@ -46,6 +75,11 @@ class PolygonApiHandler:
             sort (str): Sorting order for the data.
             ticker (str): The stock ticker symbol.
             latest (bool): Flag indicating if the latest data is requested.
+            request_scheduler (RequestScheduler): The scheduler used for all requests of this handler.
+            page_limit (int): Maximum number of bars requested per page.
+            bar_cache (BarCache): The local cache of bars, None if caching is disabled.
+            bar_dtypes (dict): The dtype per numeric bar column.
+            market_timezone (str): The timezone of the exchange.
 
         Example:
             # Example of initializing the class
@@ -72,45 +106,188 @@ class PolygonApiHandler:
         self.sort = sort
         self.ticker = ticker
         self.latest = latest
+        self.request_scheduler = request_scheduler if request_scheduler is not None else RequestScheduler()
         if not api_key:
             self.log.error("API key not found! Make sure it's set in your .env file")
             raise ValueError("API key not found! Make sure it's set in your .env file")
-        self.polygon_url = f'{self.polygon_base_url}/{self.polygon_api_version}/aggs/ticker/{self.ticker}/range/{self.number_of_time_frames}/{time_frame}/{date_to_fetch_from}/{date_to_fetch_till}?adjusted={self.adjusted}&sort={self.sort}&apiKey={api_key}' \
-            if not self.latest else f'{self.polygon_base_url}/{self.polygon_api_version}/aggs/ticker/{self.ticker}/range/1/{self.time_frame}/{datetime.now().date() - timedelta(days=1)}/{datetime.now().date()}?adjusted={self.adjusted}&sort={self.sort}&apiKey={api_key}'
+        self.api_key = api_key
+        self.page_limit = page_limit
+        self.bar_cache = bar_cache
+        self.bar_dtypes = bar_dtypes if bar_dtypes is not None else get_default_bar_dtypes()
+        self.market_timezone = market_timezone or os.getenv('market_timezone', 'America/New_York')
+        self.polygon_url = self._build_polygon_url(self.number_of_time_frames, date_to_fetch_from, date_to_fetch_till) \
+            if not self.latest else self._build_polygon_url(1, datetime.now().date() - timedelta(days=1), datetime.now().date())
+
+    @staticmethod
+    def rate_limit_key(api_key):
+        return get_polygon_rate_limit_key(api_key)
+
+    def _build_polygon_url(self, number_of_time_frames, date_to_fetch_from, date_to_fetch_till):
+        return f'{self.polygon_base_url}/{self.polygon_api_version}/aggs/ticker/{self.ticker}/range/{number_of_time_frames}/{self.time_frame}/{date_to_fetch_from}/{date_to_fetch_till}?adjusted={self.adjusted}&sort={self.sort}&limit={self.page_limit}&apiKey={self.api_key}'
+
+    def _add_api_key(self, next_url):
+        separator = '&' if '?' in next_url else '?'
+        return f'{next_url}{separator}apiKey={self.api_key}'
+
+    def _adjust_polygon_data(self, results):
+        """
+        Builds a compact bar DataFrame from the `results` of a Polygon response.
+
+        The numeric columns are cast to `self.bar_dtypes`, integer columns with missing values are kept as float64,
+        `timestamp` (UTC) is derived from the epoch milliseconds `t` column in one vectorized conversion, the date
+        column holds the trading day of the bar, its local midnight in `self.market_timezone` as datetime64, and `ticker` is a categorical column.
+        Post-market bars after 19:00 or 20:00 New York time are on the next UTC day but on the same trading day.
+
+        Args:
+            results (dict or List[dict]): The bars of one Polygon response, as the column arrays returned by
+                                          `decode_polygon_response` or as a list of bars.
+
+        Returns:
+            pd.DataFrame: The bars of the response.
+        """
+        adjusted_data = pd.DataFrame(results, copy=False) if isinstance(results, dict) else pd.DataFrame(results)
+        # Polygon leaves out fields such as `n` on some bars, integer columns holding NaN stay float64
+        # like `decode_polygon_response` does
+        adjusted_data = adjusted_data.astype({column: dtype for column, dtype in self.bar_dtypes.items()
+                                              if column in adjusted_data.columns and
+                                              (np.dtype(dtype).kind == 'f' or not adjusted_data[column].hasnans)},
+                                             copy=False)
+        adjusted_data['timestamp'] = pd.to_datetime(adjusted_data['t'].to_numpy(), unit='ms')
+        local_nanoseconds = get_local_nanoseconds(adjusted_data['timestamp'], self.market_timezone)
+        adjusted_data[self.date_column_name] = (local_nanoseconds // DAY_NANOSECONDS * DAY_NANOSECONDS).view(
+            'datetime64[ns]')
+        adjusted_data['ticker'] = pd.Categorical.from_codes(np.zeros(len(adjusted_data), dtype=np.int8),
+                                                            categories=[self.ticker])
+        return adjusted_data
+
+    def iter_polygon_data(self, polygon_url=None):
+        """
+        Streams data from the Polygon API page by page for the specified ticker.
+
+        Polygon limits the number of bars in every response and returns a `next_url` pointing to
+        the next page when the requested range holds more bars. This generator follows every
+        `next_url` until the range is exhausted and yields each page as soon as it arrives, so
+        conversion and storage of the first pages can start before the last page is fetched and
+        only one page is held in memory at a time.
+
+        Args:
+            polygon_url (str, optional): The URL of the first page, defaults to `self.polygon_url`.
+
+        Yields:
+            pd.DataFrame: The processed data of one page.
+
+        Raises:
+            ConnectionError: If the API still responds with a non 200 status code after all retries.
+            ValueError: If the first response holds no results because the request arguments are invalid,
+                        a valid range without any bars yields nothing.
+        """
+        number_of_pages = 0
+        for content in self.iter_polygon_pages(polygon_url):
+            adjusted_data = self.decode_polygon_page(content, first_page=number_of_pages == 0)
+            number_of_pages += 1
+            if adjusted_data is not None:
+                yield adjusted_data
+
+        self.log.info(f"successfully got {number_of_pages} pages of data for ticker {self.ticker}")
+
+    def iter_polygon_pages(self, polygon_url=None):
+        """
+        Follows every `next_url` of the Polygon API and yields the raw bytes of each page.
+
+        Only I/O is done here, the `next_url` is read from the bytes with `get_next_url` without decoding the
+        bars, so the pages can be decoded with `decode_polygon_page` somewhere else, e.g. in another process.
+
+        Args:
+            polygon_url (str, optional): The URL of the first page, defaults to `self.polygon_url`.
+
+        Yields:
+            bytes: The body of one page.
+
+        Raises:
+            ConnectionError: If the API still responds with a non 200 status code after all retries.
+        """
+        url = polygon_url or self.polygon_url
+
+        while url:
+            polygon_response = self.request_scheduler.get(url, rate_limit_key=self.rate_limit_key(self.api_key))
+            if polygon_response.status_code != 200:
+                self.log.error(f"Error {polygon_response.status_code}: {polygon_response.text}")
+                raise ConnectionError(f"Error {polygon_response.status_code} while fetching data for ticker {self.ticker}")
+
+            next_url = get_next_url(polygon_response.content)
+            url = self._add_api_key(next_url) if next_url else None
+            yield polygon_response.content
+
+    def decode_polygon_page(self, content, first_page=True):
+        """
+        Decodes the bytes of one Polygon page into the bars DataFrame of `_adjust_polygon_data`.
+
+        Args:
+            content (bytes): The body of the page.
+            first_page (bool): Whether this is the first page of the request, a first page without results
+                               means the request arguments are invalid.
+
+        Returns:
+            pd.DataFrame: The bars of the page, None if the page holds no bars.
+
+        Raises:
+            ValueError: If the first page holds no results because the request arguments are invalid.
+        """
+        with metrics.span('polygon_json_parse'):
+            data = decode_polygon_response(content, dtypes=self.bar_dtypes)
+        if 'results' not in data.keys():
+            if not first_page or data.get('resultsCount') == 0:
+                return None
+            self.log.error(f"one of the arguments to the API get request of ticker {self.ticker} is invalid \n")
+            raise ValueError(f"one of the arguments to the API get request of ticker {self.ticker} is invalid \n"
+                             f"please read again the API doc in https://polygon.io/docs/stocks/get_v2_aggs_ticker__stocksticker__range__multiplier___timespan___from___to")
+        if not len(data['results'].get('t', ())):
+            return None
+
+        with metrics.span('polygon_frame_build'):
+            adjusted_data = self._adjust_polygon_data(data['results'])
+        metrics.increment('rows_total', len(adjusted_data), stage='polygon_fetch')
+        return adjusted_data
 
     def get_polygon_data(self):
         """
         Fetches data from the Polygon API and adjusts the data for the specified ticker.
 
-        This function sends an HTTP GET request to the Polygon API using the URL defined in
-        the `self.polygon_url` attribute. It processes the returned JSON response, extracting
-        relevant data (stock price or other financial data), converting Unix epoch timestamps
+        This function follows every page of the Polygon response using `iter_polygon_data`, starting
+        from the URL defined in the `self.polygon_url` attribute. It processes the returned JSON responses,
+        extracting relevant data (stock price or other financial data), converting Unix epoch timestamps
         into human-readable datetime objects, and adds the formatted date column to the DataFrame.
 
+        When a bar cache is configured and historical data is requested, only the date ranges missing
+        from the cache are fetched from the API and the whole range is then served from the cache.
+
         The function logs the success of the request or any errors that occur during the process.
 
         Returns:
             pd.DataFrame: A DataFrame containing the processed data , else None.
+
+        Raises:
+            ConnectionError: If the API responds with a non 200 status code.
         """
-        polygon_response = requests.get(self.polygon_url)
-        adjusted_data = None
-
-        if polygon_response.status_code == 200:
-            data = polygon_response.json()
-            if 'results' in data.keys():
-                data = data['results']
-            else:
-                self.log.error(f"one of the arguments to the API get request is invalid {self.polygon_url} \n")
-                raise ValueError(f"one of the arguments to the API get request is invalid {self.polygon_url} \n"
-                                 f"please read again the API doc in https://polygon.io/docs/stocks/get_v2_aggs_ticker__stocksticker__range__multiplier___timespan___from___to")
-
-            adjusted_data = pd.DataFrame(data)
-            adjusted_data['timestamp'] = adjusted_data['t'].apply(lambda epoch: datetime.fromtimestamp(epoch / 1000))
-            adjusted_data[self.date_column_name] = adjusted_data['timestamp'].apply(lambda x: str(x.date()))
-            adjusted_data['ticker'] = self.ticker
-            self.log.info(f"successfully got data for ticker {self.ticker}:")
+        if self.bar_cache is not None and not self.latest:
+            adjusted_data = self._get_cached_polygon_data()
         else:
-            self.log.error(f"Error {polygon_response.status_code}: {polygon_response.text}")
-            sys.exit(0)
+            pages = list(self.iter_polygon_data())
+            adjusted_data = pd.concat(pages, ignore_index=True) if pages else None
+        self.log.info(f"successfully got data for ticker {self.ticker}:")
+
+        return adjusted_data
+
+    def _get_cached_polygon_data(self):
+        key = self.bar_cache.make_key(self.ticker, self.number_of_time_frames, self.time_frame, self.adjusted)
+        gaps = self.bar_cache.missing_intervals(key, self.date_to_fetch_from, self.date_to_fetch_till)
+
+        for gap_from, gap_till in gaps:
+            pages = list(self.iter_polygon_data(self._build_polygon_url(self.number_of_time_frames, gap_from, gap_till)))
+            self.bar_cache.store(key, pd.concat(pages, ignore_index=True) if pages else None, gap_from, gap_till)
+        self.log.debug(f"fetched {len(gaps)} missing date ranges for ticker {self.ticker} from the API")
 
+        adjusted_data = self.bar_cache.load(key, self.date_to_fetch_from, self.date_to_fetch_till)
+        if adjusted_data is not None and self.sort == 'desc':
+            adjusted_data = adjusted_data.iloc[::-1].reset_index(drop=True)
         return adjusted_data
@@ -0,0 +1,269 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from logger import Logger, metrics
+import logging
+import pandas as pd
+from dotenv import load_dotenv
+
+from config_handler import Configs
+from currency_convertor import convert_currency_in_stock_price_df, get_currency_column
+from database_writer import DatabaseWriter
+from frankfurter_api_handler import FrankfurterApiHandler
+from fx_rate_store import FxRateStore
+from polygon_api_handler import PolygonApiHandler
+from request_scheduler import RequestScheduler
+from resampler import TIME_FRAMES, IncrementalResampler, check_resample_time_frames, get_bucket_range
+
+load_dotenv()
+
+TIME_FRAME_SECONDS = {'second': 1, 'minute': 60, 'hour': 60 * 60, 'day': 24 * 60 * 60, 'week': 7 * 24 * 60 * 60,
+                      'month': 30 * 24 * 60 * 60, 'quarter': 91 * 24 * 60 * 60, 'year': 365 * 24 * 60 * 60}
+
+
+class RefreshDaemon:
+    def __init__(self, configs, time_frames, request_scheduler, rate_store, database_writer,
+                 refresh_interval_seconds=None):
+        """
+        Initializes the RefreshDaemon class, a resident service which keeps the stock price tables up to date.
+
+        Instead of running main.py again from cron for every interval, the daemon stays alive and keeps the
+        request scheduler (and its keep-alive connections), the FX rate store and the database connection warm.
+        On every tick of a time frame it fetches, for every ticker, only the bars newer than the last stored
+        timestamp, converts every bar with the exchange rate valid on its day and upserts them. The new bars are
+        rolled up into the coarser `resample_time_frames` of the configs with an `IncrementalResampler` per
+        ticker, seeded with the stored bars of the buckets still open at the last stored bar.
+
+        Args:
+            configs (Configs): The configuration of the run (tickers, currencies, columns to convert, ...).
+            time_frames (List[str]): The time frames to refresh, each one on its own schedule.
+            request_scheduler (RequestScheduler): The scheduler all API requests are sent through.
+            rate_store (FxRateStore): The store serving the latest exchange rates.
+            database_writer (DatabaseWriter): The writer of the stock price and currency tables.
+            refresh_interval_seconds (float, optional): Seconds between two ticks of every time frame, defaults
+                                                        to the length of `number_of_time_frames` time frames.
+
+        Example:
+            refresh_daemon = RefreshDaemon.from_configs(Configs())
+            refresh_daemon.run()
+        """
+        self.log = Logger(name=__name__, log_file="logs/app.log", level=logging.DEBUG).get_logger()
+        self.configs = configs
+        self.time_frames = time_frames
+        self.request_scheduler = request_scheduler
+        self.rate_store = rate_store
+        self.database_writer = database_writer
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.last_timestamps = {}
+        self.incremental_resamplers = {}
+        self._stop_event = threading.Event()
+
+    @classmethod
+    def from_configs(cls, configs):
+        """
+        Creates a RefreshDaemon and its long living dependencies from the Configs class.
+        """
+        if configs.refresh_time_frames:
+            check_resample_time_frames(min(configs.refresh_time_frames, key=TIME_FRAMES.index),
+                                       configs.resample_time_frames)
+        return cls(configs=configs,
+                   time_frames=configs.refresh_time_frames,
+                   request_scheduler=RequestScheduler.from_configs(configs),
+                   rate_store=FxRateStore.from_configs(configs),
+                   database_writer=DatabaseWriter.from_configs(configs),
+                   refresh_interval_seconds=configs.refresh_interval_seconds or None)
+
+    def _interval_seconds(self, time_frame):
+        if self.refresh_interval_seconds:
+            return self.refresh_interval_seconds
+        return TIME_FRAME_SECONDS[time_frame] * int(self.configs.number_of_time_frames)
+
+    def _get_currency_data(self):
+        frankfurter_handler = FrankfurterApiHandler(ticker=",".join(self.configs.tickers),
+                                                    date_to_fetch_from=None,
+                                                    date_to_fetch_till=None,
+                                                    base_currency=self.configs.base_currency,
+                                                    date_column_name=self.configs.date_column_name,
+                                                    latest=True,
+                                                    request_scheduler=self.request_scheduler,
+                                                    rate_store=self.rate_store)
+        return frankfurter_handler.get_frankfurter_data()
+
+    def _get_rates_since(self, date_to_fetch_from, currency_data):
+        """
+        Returns the exchange rates from `date_to_fetch_from` up to now, the published rates of the days before
+        today from the rate store followed by the latest rates. After a downtime, or on a first run against an
+        old table, the bars of the past days are then converted with the rates of their own day.
+        """
+        yesterday = datetime.now().date() - timedelta(days=1)
+        if date_to_fetch_from > yesterday:
+            return currency_data
+        frankfurter_handler = FrankfurterApiHandler(ticker=",".join(self.configs.tickers),
+                                                    date_to_fetch_from=date_to_fetch_from,
+                                                    date_to_fetch_till=yesterday,
+                                                    base_currency=self.configs.base_currency,
+                                                    date_column_name=self.configs.date_column_name,
+                                                    latest=False,
+                                                    request_scheduler=self.request_scheduler,
+                                                    rate_store=self.rate_store)
+        past_currency_data = frankfurter_handler.get_frankfurter_data()
+        if past_currency_data is None:
+            return currency_data
+        currency_data = pd.concat([past_currency_data, currency_data], ignore_index=True)
+        return currency_data.drop_duplicates(subset=self.configs.date_column_name, keep='last')
+
+    def _target_currency(self, currency_data):
+        if currency_data is not None and self.configs.currency_to_convert_to in currency_data.columns:
+            return self.configs.currency_to_convert_to
+        return self.configs.base_currency
+
+    def _resample(self, key, stock_price_data, last_timestamp):
+        """
+        Rolls the new bars of a (ticker, time_frame, currency) key up into the configured coarser time frames
+        and upserts the new and updated coarse bars.
+        """
+        ticker, time_frame, currency = key
+        resample_time_frames = [resample_time_frame for resample_time_frame in self.configs.resample_time_frames
+                                if TIME_FRAMES.index(resample_time_frame) > TIME_FRAMES.index(time_frame)]
+        if not resample_time_frames:
+            return
+        incremental_resampler = self.incremental_resamplers.get(key)
+        if incremental_resampler is None:
+            incremental_resampler = IncrementalResampler(resample_time_frames,
+                                                         timezone=self.configs.market_timezone,
+                                                         session_start=self.configs.session_start,
+                                                         session_end=self.configs.session_end,
+                                                         date_column_name=self.configs.date_column_name)
+            if last_timestamp is not None:
+                # the open buckets are read back whole, so the first update does not replace them by partial bars
+                timestamp_from = min(get_bucket_range(pd.Series([last_timestamp]), resample_time_frame,
+                                                      timezone=self.configs.market_timezone)[0]
+                                     for resample_time_frame in resample_time_frames)
+                stored_stock_price_data = self.database_writer.read_stock_price_data(
+                    time_frame, [ticker], [currency], timestamp_from, stock_price_data['timestamp'].min())
+                if not stored_stock_price_data.empty:
+                    incremental_resampler.update(stored_stock_price_data)
+            self.incremental_resamplers[key] = incremental_resampler
+
+        for resample_time_frame, resampled in incremental_resampler.update(stock_price_data).items():
+            self.database_writer.write_stock_price_data(resampled, time_frame=resample_time_frame)
+
+    def refresh_ticker(self, ticker, time_frame, currency_data):
+        """
+        Fetches, converts and stores the bars of a ticker which are newer than its last stored bar.
+
+        Args:
+            ticker (str): The stock ticker symbol.
+            time_frame (str): The time frame of the bars.
+            currency_data (pd.DataFrame): The latest exchange rates, None if they are not available. The rates of
+                                          the days before today are added from the rate store.
+
+        Returns:
+            int: Number of new bars stored.
+        """
+        currency = self._target_currency(currency_data)
+        key = (ticker, time_frame, currency)
+        if key not in self.last_timestamps:
+            self.last_timestamps[key] = self.database_writer.get_latest_timestamp(ticker, time_frame, currency)
+        last_timestamp = self.last_timestamps[key]
+
+        today = datetime.now().date()
+        date_to_fetch_from = last_timestamp.date() if last_timestamp is not None else today - timedelta(days=1)
+        # Polygon accepts the start of the range as epoch milliseconds, so only the bars after the last
+        # stored one are requested and not the whole day again on every tick
+        polygon_from = pd.Timestamp(last_timestamp).value // 10 ** 6 + 1 if last_timestamp is not None \
+            else date_to_fetch_from
+        polygon_api_handler = PolygonApiHandler(ticker=ticker,
+                                                date_to_fetch_from=polygon_from,
+                                                date_to_fetch_till=today,
+                                                number_of_time_frames=self.configs.number_of_time_frames,
+                                                time_frame=time_frame,
+                                                adjusted=self.configs.adjusted,
+                                                sort='asc',
+                                                api_key=self.configs.api_key,
+                                                date_column_name=self.configs.date_column_name,
+                                                latest=False,
+                                                request_scheduler=self.request_scheduler)
+        stock_price_data = polygon_api_handler.get_polygon_data()
+        if stock_price_data is not None and last_timestamp is not None:
+            # guards against a bar at the boundary being returned again
+            stock_price_data = stock_price_data[stock_price_data['timestamp'] > last_timestamp].reset_index(drop=True)
+        if stock_price_data is None or stock_price_data.empty:
+            return 0
+
+        if currency != self.configs.base_currency:
+            columns_to_convert = [col for col in self.configs.stock_price_column_to_convert
+                                  if col in stock_price_data.columns]
+            stock_price_data, _ = convert_currency_in_stock_price_df(stock_price_data=stock_price_data,
+                                                                     latest=False,
+                                                                     currency_data=self._get_rates_since(
+                                                                         date_to_fetch_from, currency_data),
+                                                                     date_column_name=self.configs.date_column_name,
+                                                                     stock_price_column_to_convert=columns_to_convert,
+                                                                     currency_to_convert_to=currency)
+        else:
+            stock_price_data['currency'] = get_currency_column(currency, len(stock_price_data))
+
+        self.database_writer.write_stock_price_data(stock_price_data, time_frame=time_frame)
+        self._resample(key, stock_price_data, last_timestamp)
+        self.last_timestamps[key] = stock_price_data['timestamp'].max()
+        return len(stock_price_data)
+
+    def refresh(self, time_frame):
+        """
+        Runs one tick of a time frame, refreshing all tickers concurrently.
+        A failure of one ticker is logged and does not stop the others.
+        """
+        currency_data = self._get_currency_data()
+        if currency_data is not None:
+            rates_to_store = currency_data.drop(self.configs.date_column_name, axis=1)
+            rates_to_store['timestamp'] = pd.to_datetime(currency_data[self.configs.date_column_name])
+            self.database_writer.write_currency_data(rates_to_store)
+
+        with ThreadPoolExecutor(max_workers=self.configs.max_workers) as executor:
+            futures = {ticker: executor.submit(self.refresh_ticker, ticker, time_frame, currency_data)
+                       for ticker in self.configs.tickers}
+        number_of_bars = 0
+        for ticker, future in futures.items():
+            try:
+                number_of_bars += future.result()
+            except Exception as e:
+                self.log.error(f"failed to refresh ticker {ticker} for time frame {time_frame}: {e}")
+        self.log.info(f"refreshed {time_frame} bars of {len(self.configs.tickers)} tickers, "
+                      f"{number_of_bars} new bars stored")
+        if self.configs.metrics_path:
+            metrics.export(self.configs.metrics_path)
+
+    def run(self):
+        """
+        Runs the daemon until `stop` is called, every time frame is refreshed once at start up and then
+        on its own schedule.
+        """
+        next_runs = {time_frame: time.monotonic() for time_frame in self.time_frames}
+        self.log.info(f"refresh daemon started for time frames {self.time_frames}")
+        try:
+            while not self._stop_event.is_set():
+                time_frame = min(next_runs, key=next_runs.get)
+                if self._stop_event.wait(max(0.0, next_runs[time_frame] - time.monotonic())):
+                    break
+                try:
+                    self.refresh(time_frame)
+                except Exception as e:
+                    self.log.error(f"refresh of time frame {time_frame} failed: {e}")
+                next_runs[time_frame] = max(next_runs[time_frame] + self._interval_seconds(time_frame),
+                                            time.monotonic())
+        finally:
+            self.database_writer.close()
+            self.log.info("refresh daemon stopped")
+
+    def stop(self):
+        self._stop_event.set()
+
+
+if __name__ == '__main__':
+    try:
+        RefreshDaemon.from_configs(Configs()).run()
+    except KeyboardInterrupt:
+        pass
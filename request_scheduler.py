@@ -0,0 +1,183 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from logger import Logger, metrics
+import logging
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def get_polygon_rate_limit_key(api_key):
+    return f'polygon:{api_key}'
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute, capacity=None):
+        """
+        Thread safe token bucket, allows `rate_per_minute` requests per minute with bursts of up to `capacity`.
+
+        Args:
+            rate_per_minute (float): Number of tokens added every minute.
+            capacity (float, optional): Maximum number of stored tokens, defaults to `rate_per_minute`.
+        """
+        self.rate_per_second = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate_per_second
+            time.sleep(wait_seconds)
+
+    def pause(self, seconds):
+        """
+        Empties the bucket so no request is sent during the next `seconds` seconds, used when the API throttles us.
+        """
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate_per_second
+            self.updated_at = time.monotonic()
+
+
+class RequestScheduler:
+    def __init__(self, max_retries=5, backoff_base_seconds=0.5, backoff_max_seconds=60, timeout_seconds=30,
+                 pool_size=10):
+        """
+        Initializes the RequestScheduler class, the single place all API handlers send their requests through.
+
+        Requests are rate limited with one token bucket per rate limit key (e.g. per API key),
+        so a large batch runs at the highest throughput the quota allows. Responses with status 429
+        pause the bucket for the `Retry-After` period, responses with a 5xx status and timeouts or
+        connection errors are retried with jittered exponential backoff, and every request has a timeout.
+        All requests share one pooled HTTP session.
+
+        Args:
+            max_retries (int): Maximum number of retries of a request before giving up.
+            backoff_base_seconds (float): Backoff before the first retry, doubled on every retry.
+            backoff_max_seconds (float): Upper bound of the backoff between retries.
+            timeout_seconds (float): Connect and read timeout of every request.
+            pool_size (int): Maximum number of connections kept alive per host.
+
+        Example:
+            request_scheduler = RequestScheduler(max_retries=5, timeout_seconds=30)
+            request_scheduler.set_rate_limit(key="polygon:your_api_key", rate_per_minute=5)
+            response = request_scheduler.get(url, rate_limit_key="polygon:your_api_key")
+        """
+        self.log = Logger(name=__name__, log_file="logs/app.log", level=logging.DEBUG).get_logger()
+        self.max_retries = max_retries
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.timeout_seconds = timeout_seconds
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+
+    @classmethod
+    def from_configs(cls, configs):
+        """
+        Creates a RequestScheduler from the `request_*` values of the Configs class, with a connection per
+        worker and the Polygon requests of the API key limited to `polygon_requests_per_minute`.
+        """
+        request_scheduler = cls(max_retries=configs.request_max_retries,
+                                timeout_seconds=configs.request_timeout_seconds,
+                                pool_size=configs.max_workers + 1)
+        request_scheduler.set_rate_limit(get_polygon_rate_limit_key(configs.api_key),
+                                         configs.polygon_requests_per_minute)
+        return request_scheduler
+
+    def set_rate_limit(self, key, rate_per_minute, capacity=None):
+        """
+        Limits the requests of a rate limit key, a rate of 0 or None means unlimited.
+
+        Args:
+            key (str): The rate limit key, e.g. "polygon:<api key>".
+            rate_per_minute (float): Maximum number of requests per minute.
+            capacity (float, optional): Maximum burst of requests, defaults to `rate_per_minute`.
+        """
+        with self._buckets_lock:
+            self._buckets[key] = TokenBucket(rate_per_minute, capacity) if rate_per_minute else None
+
+    def _backoff_seconds(self, attempt):
+        return random.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** attempt))
+
+    @staticmethod
+    def _retry_after_seconds(response):
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is None:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+
+    def get(self, url, rate_limit_key=None):
+        """
+        Sends a GET request, waiting for the rate limit and retrying throttled and failed requests.
+
+        Args:
+            url (str): The URL to request.
+            rate_limit_key (str, optional): The rate limit key of the request, not rate limited if None.
+
+        Returns:
+            requests.Response: The response, which has a non retryable status or is the last attempt.
+
+        Raises:
+            requests.RequestException: If the request still fails with a timeout or connection error
+                                       after all retries.
+        """
+        bucket = self._buckets.get(rate_limit_key)
+        api = urlparse(url).hostname
+        attempt = 0
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+            if attempt > 0:
+                metrics.increment('api_retries_total', api=api)
+            metrics.increment('api_requests_total', api=api)
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, timeout=self.timeout_seconds)
+                metrics.observe('api_request_duration_seconds', time.perf_counter() - start, api=api)
+                metrics.increment('api_response_bytes_total', len(response.content), api=api)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                if attempt >= self.max_retries:
+                    self.log.error(f"request failed after {attempt} retries: {e}")
+                    raise
+                wait_seconds = self._backoff_seconds(attempt)
+                self.log.debug(f"request failed with {type(e).__name__}, retrying in {wait_seconds:.2f} seconds")
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    return response
+                wait_seconds = self._retry_after_seconds(response) if response.status_code == 429 else None
+                if wait_seconds is None:
+                    wait_seconds = self._backoff_seconds(attempt)
+                self.log.debug(f"request returned status {response.status_code}, "
+                               f"retrying in {wait_seconds:.2f} seconds")
+                if response.status_code == 429 and bucket is not None:
+                    # the bucket holds back every request of this key, not only this one
+                    bucket.pause(wait_seconds)
+                    wait_seconds = 0
+            attempt += 1
+            time.sleep(wait_seconds)
@@ -0,0 +1,276 @@
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from logger import metrics
+
+SUB_DAY_NANOSECONDS = {'second': 10 ** 9, 'minute': 60 * 10 ** 9, 'hour': 60 * 60 * 10 ** 9}
+DAY_NANOSECONDS = 24 * 60 * 60 * 10 ** 9
+# 1970-01-01 is a Thursday, weeks are anchored on the following Monday
+WEEK_ORIGIN_NANOSECONDS = 4 * DAY_NANOSECONDS
+MONTHS_PER_TIME_FRAME = {'month': 1, 'quarter': 3, 'year': 12}
+GROUP_COLUMNS = ['ticker', 'currency']
+TIME_FRAMES = list(SUB_DAY_NANOSECONDS) + ['day', 'week'] + list(MONTHS_PER_TIME_FRAME)
+
+
+def _time_of_day_nanoseconds(time_of_day: str) -> int:
+    hours, minutes = time_of_day.split(':')
+    return (int(hours) * 60 + int(minutes)) * 60 * 10 ** 9
+
+
+def get_local_nanoseconds(timestamps: pd.Series, timezone: str) -> np.ndarray:
+    """
+        Returns the wall clock time of UTC timestamps in a timezone, as int64 nanoseconds since the epoch.
+        """
+    local_timestamps = timestamps.dt.tz_localize('UTC').dt.tz_convert(timezone).dt.tz_localize(None)
+    return local_timestamps.to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+
+def get_session_mask(timestamps: pd.Series, timezone: str, session_start: str = None,
+                     session_end: str = None) -> np.ndarray:
+    """
+        Returns a boolean mask of the timestamps inside the trading session [session_start, session_end),
+        given as "HH:MM" wall clock times of the timezone. Without a session every timestamp is kept.
+        """
+    if not session_start and not session_end:
+        return np.ones(len(timestamps), dtype=bool)
+    time_of_day = get_local_nanoseconds(timestamps, timezone) % DAY_NANOSECONDS
+    mask = np.ones(len(timestamps), dtype=bool)
+    if session_start:
+        mask &= time_of_day >= _time_of_day_nanoseconds(session_start)
+    if session_end:
+        mask &= time_of_day < _time_of_day_nanoseconds(session_end)
+    return mask
+
+
+def get_bucket_timestamps(timestamps: pd.Series, time_frame: str, number_of_time_frames: int = 1,
+                          timezone: str = 'UTC') -> np.ndarray:
+    """
+        Returns the start of the time frame bucket of every timestamp.
+
+        Buckets are aligned on the wall clock of `timezone`: an hour bucket starts on a local full hour, a day
+        bucket at local midnight, a week bucket on Monday, and month, quarter and year buckets on the first day
+        of the period. The bucket starts are returned as naive UTC datetime64 values, the convention of the
+        `timestamp` column, so they stay correct across daylight saving time changes.
+
+        Args:
+            timestamps (pd.Series): The naive UTC timestamps of the bars.
+            time_frame (str): The target time frame, one of second, minute, hour, day, week, month, quarter, year.
+            number_of_time_frames (int): The number of time frames in a bucket, e.g. 15 for 15 minute bars.
+            timezone (str): The timezone the buckets are aligned on, e.g. "America/New_York".
+
+        Returns:
+            np.ndarray: The datetime64[ns] bucket start of every timestamp.
+        """
+    number_of_time_frames = int(number_of_time_frames)
+    utc_nanoseconds = timestamps.to_numpy(dtype='datetime64[ns]').view(np.int64)
+    local_nanoseconds = get_local_nanoseconds(timestamps, timezone)
+
+    if time_frame in SUB_DAY_NANOSECONDS:
+        # shifting back by the offset of each bar keeps the buckets right on both sides of a DST change
+        bucket_size = SUB_DAY_NANOSECONDS[time_frame] * number_of_time_frames
+        utc_offsets = local_nanoseconds - utc_nanoseconds
+        return (local_nanoseconds // bucket_size * bucket_size - utc_offsets).view('datetime64[ns]')
+
+    if time_frame == 'day':
+        bucket_size = DAY_NANOSECONDS * number_of_time_frames
+        local_buckets = local_nanoseconds // bucket_size * bucket_size
+    elif time_frame == 'week':
+        bucket_size = 7 * DAY_NANOSECONDS * number_of_time_frames
+        local_buckets = (local_nanoseconds - WEEK_ORIGIN_NANOSECONDS) // bucket_size * bucket_size + \
+            WEEK_ORIGIN_NANOSECONDS
+    elif time_frame in MONTHS_PER_TIME_FRAME:
+        bucket_size = MONTHS_PER_TIME_FRAME[time_frame] * number_of_time_frames
+        months = local_nanoseconds.view('datetime64[ns]').astype('datetime64[M]').astype(np.int64)
+        local_buckets = (months // bucket_size * bucket_size).astype('datetime64[M]').astype('datetime64[ns]')
+        local_buckets = local_buckets.view(np.int64)
+    else:
+        raise ValueError(f"unknown time_frame {time_frame}, please select one of "
+                         f"{list(SUB_DAY_NANOSECONDS) + ['day', 'week'] + list(MONTHS_PER_TIME_FRAME)}")
+
+    # local midnights are few, so only the distinct bucket starts are converted back to UTC
+    unique_buckets, bucket_codes = np.unique(local_buckets, return_inverse=True)
+    unique_buckets = pd.DatetimeIndex(unique_buckets.view('datetime64[ns]')).tz_localize(
+        timezone, ambiguous=np.ones(len(unique_buckets), dtype=bool), nonexistent='shift_forward')
+    unique_buckets = unique_buckets.tz_convert('UTC').tz_localize(None).to_numpy(dtype='datetime64[ns]')
+    return unique_buckets[bucket_codes.reshape(-1)]
+
+
+def check_resample_time_frames(time_frame: str, resample_time_frames: List[str]):
+    """
+        Checks that bars of `time_frame` can be rolled up into every one of `resample_time_frames`.
+
+        Raises:
+            ValueError: If a time frame is unknown or finer than `time_frame`.
+        """
+    for resample_time_frame in [time_frame] + list(resample_time_frames):
+        if resample_time_frame not in TIME_FRAMES:
+            raise ValueError(f"unknown time_frame {resample_time_frame}, please select one of {TIME_FRAMES}")
+    finer_time_frames = [resample_time_frame for resample_time_frame in resample_time_frames
+                         if TIME_FRAMES.index(resample_time_frame) < TIME_FRAMES.index(time_frame)]
+    if finer_time_frames:
+        raise ValueError(f"resample time frames {finer_time_frames} are finer than the time frame {time_frame} "
+                         f"of the bars, please select some of {TIME_FRAMES[TIME_FRAMES.index(time_frame):]}")
+
+
+def get_bucket_range(timestamps: pd.Series, time_frame: str, number_of_time_frames: int = 1,
+                     timezone: str = 'UTC'):
+    """
+        Returns the start of the first and the end of the last time frame bucket holding the timestamps, so
+        the fine bars of every bucket they touch can be read back whole before the buckets are rolled up again.
+
+        Returns:
+            pd.Timestamp: The naive UTC start of the first bucket, included.
+            pd.Timestamp: The naive UTC end of the last bucket, excluded.
+        """
+    number_of_time_frames = int(number_of_time_frames)
+    bucket_starts = get_bucket_timestamps(timestamps, time_frame, number_of_time_frames, timezone)
+    first_start, last_start = pd.Timestamp(bucket_starts.min()), pd.Timestamp(bucket_starts.max())
+    if time_frame in SUB_DAY_NANOSECONDS:
+        return first_start, last_start + pd.Timedelta(SUB_DAY_NANOSECONDS[time_frame] * number_of_time_frames)
+
+    if time_frame == 'day':
+        offset = pd.DateOffset(days=number_of_time_frames)
+    elif time_frame == 'week':
+        offset = pd.DateOffset(weeks=number_of_time_frames)
+    else:
+        offset = pd.DateOffset(months=MONTHS_PER_TIME_FRAME[time_frame] * number_of_time_frames)
+    local_end = last_start.tz_localize('UTC').tz_convert(timezone).tz_localize(None) + offset
+    last_end = local_end.tz_localize(timezone, ambiguous=True, nonexistent='shift_forward')
+    return first_start, last_end.tz_convert('UTC').tz_localize(None)
+
+
+@metrics.timer('resample')
+def resample_bars(stock_price_data: pd.DataFrame, time_frame: str, number_of_time_frames: int = 1,
+                  timezone: str = 'UTC', session_start: str = None, session_end: str = None,
+                  date_column_name: str = 'Date') -> pd.DataFrame:
+    """
+        Rolls fine grained bars up into a coarser time frame.
+
+        Every (ticker, currency, bucket) group is aggregated in one vectorized groupby with the OHLCV
+        semantics of the Polygon aggregates: `o` is the first open, `h` the highest high, `l` the lowest low,
+        `c` the last close, `v` and `n` are summed and `vw` is the volume weighted average of the bar vwaps.
+        Bars outside of the trading session are dropped before the rollup, so e.g. the day bars of a minute
+        table hold the regular session only when `session_start="09:30"` and `session_end="16:00"` are given.
+
+        Args:
+            stock_price_data (pd.DataFrame): The fine grained bars, as returned by `PolygonApiHandler`.
+            time_frame (str): The target time frame (e.g., "hour", "day", "week").
+            number_of_time_frames (int): The number of time frames per resampled bar.
+            timezone (str): The timezone the buckets and the session are aligned on.
+            session_start (str, optional): Local start of the trading session, "HH:MM".
+            session_end (str, optional): Local end of the trading session, "HH:MM", exclusive.
+            date_column_name (str): The name of the date column.
+
+        Returns:
+            pd.DataFrame: The resampled bars with the columns and dtypes of `stock_price_data`, `t` and
+                          `timestamp` holding the start of every bucket.
+
+        Example:
+            day_bars = resample_bars(minute_bars, time_frame="day", timezone="America/New_York",
+                                     session_start="09:30", session_end="16:00")
+        """
+    session_mask = get_session_mask(stock_price_data['timestamp'], timezone, session_start, session_end)
+    bars = stock_price_data[session_mask] if not session_mask.all() else stock_price_data
+    group_columns = [col for col in GROUP_COLUMNS if col in bars.columns]
+
+    bucket = get_bucket_timestamps(bars['timestamp'], time_frame, number_of_time_frames, timezone)
+    volume = bars['v'].to_numpy(dtype=np.float64)
+    aggregation_input = pd.DataFrame({col: bars[col].to_numpy() for col in group_columns} |
+                                     {'bucket': bucket, 't': bars['t'].to_numpy()}, copy=False)
+    aggregations = {}
+    for col, function in (('o', 'first'), ('h', 'max'), ('l', 'min'), ('c', 'last'), ('v', 'sum'), ('n', 'sum')):
+        if col in bars.columns:
+            aggregation_input[col] = bars[col].to_numpy()
+            aggregations[col] = (col, function)
+    if 'vw' in bars.columns:
+        aggregation_input['vw_volume'] = bars['vw'].to_numpy(dtype=np.float64) * volume
+        aggregation_input['vw_weight'] = np.where(np.isnan(aggregation_input['vw_volume']), 0.0, volume)
+        aggregations['vw_volume'] = ('vw_volume', 'sum')
+        aggregations['vw_weight'] = ('vw_weight', 'sum')
+
+    # first and last follow the bar order, so the bars are sorted by time inside every group
+    aggregation_input = aggregation_input.sort_values('t', kind='stable')
+    resampled = aggregation_input.groupby(group_columns + ['bucket'], sort=True).agg(**aggregations).reset_index()
+
+    if 'vw' in bars.columns:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            resampled['vw'] = np.where(resampled['vw_weight'] > 0,
+                                       resampled['vw_volume'] / resampled['vw_weight'], np.nan)
+        resampled = resampled.drop(['vw_volume', 'vw_weight'], axis=1)
+
+    resampled['timestamp'] = resampled.pop('bucket').to_numpy(dtype='datetime64[ns]')
+    resampled['t'] = resampled['timestamp'].to_numpy(dtype='datetime64[ms]').view(np.int64)
+    if date_column_name in bars.columns:
+        local_nanoseconds = get_local_nanoseconds(resampled['timestamp'], timezone)
+        resampled[date_column_name] = (local_nanoseconds // DAY_NANOSECONDS * DAY_NANOSECONDS).view('datetime64[ns]')
+    columns = [col for col in stock_price_data.columns if col in resampled.columns]
+    return resampled[columns].astype(stock_price_data[columns].dtypes.to_dict())
+
+
+class IncrementalResampler:
+    def __init__(self, time_frames: List[str], number_of_time_frames: int = 1, timezone: str = 'UTC',
+                 session_start: str = None, session_end: str = None, date_column_name: str = 'Date'):
+        """
+        Initializes the IncrementalResampler class, which derives coarser time frames from fine grained
+        bars as they are appended.
+
+        The resampler keeps the fine bars of the last, still open, bucket of every (ticker, currency) group.
+        On every update these bars are rolled up again together with the new ones, so only the open bucket
+        and the new buckets are recomputed. The rows of the open bucket are returned again on every update
+        until it closes, writing them with the upserting `DatabaseWriter` replaces the partial bar. The first
+        update must hold every fine bar of the buckets it touches, or the partial bar it derives replaces a
+        complete one.
+
+        Args:
+            time_frames (List[str]): The time frames to derive (e.g., ["hour", "day"]).
+            number_of_time_frames (int): The number of time frames per resampled bar.
+            timezone (str): The timezone the buckets and the session are aligned on.
+            session_start (str, optional): Local start of the trading session, "HH:MM".
+            session_end (str, optional): Local end of the trading session, "HH:MM", exclusive.
+            date_column_name (str): The name of the date column.
+
+        Example:
+            incremental_resampler = IncrementalResampler(["hour", "day"], timezone="America/New_York")
+            for time_frame, resampled in incremental_resampler.update(new_minute_bars).items():
+                database_writer.write_stock_price_data(resampled, time_frame=time_frame)
+        """
+        self.time_frames = time_frames
+        self.number_of_time_frames = number_of_time_frames
+        self.timezone = timezone
+        self.session_start = session_start
+        self.session_end = session_end
+        self.date_column_name = date_column_name
+        self._open_bars = {}
+
+    def update(self, new_stock_price_data: pd.DataFrame):
+        """
+        Rolls newly appended fine bars up into every time frame.
+
+        Args:
+            new_stock_price_data (pd.DataFrame): The new fine grained bars.
+
+        Returns:
+            Dict[str, pd.DataFrame]: The new and updated resampled bars per time frame.
+        """
+        resampled_per_time_frame = {}
+        for time_frame in self.time_frames:
+            open_bars = self._open_bars.get(time_frame)
+            bars = new_stock_price_data if open_bars is None else \
+                pd.concat([open_bars, new_stock_price_data], ignore_index=True)
+            group_columns = [col for col in GROUP_COLUMNS if col in bars.columns]
+            bars = bars.drop_duplicates(subset=group_columns + ['t'], keep='last').reset_index(drop=True)
+            if bars.empty:
+                continue
+
+            resampled_per_time_frame[time_frame] = resample_bars(
+                bars, time_frame, self.number_of_time_frames, self.timezone, self.session_start,
+                self.session_end, self.date_column_name)
+
+            bucket = pd.Series(get_bucket_timestamps(bars['timestamp'], time_frame, self.number_of_time_frames,
+                                                     self.timezone))
+            last_bucket = bucket.groupby([bars[col] for col in group_columns], observed=True).transform('max') \
+                if group_columns else bucket.max()
+            self._open_bars[time_frame] = bars[(bucket == last_bucket).to_numpy()].reset_index(drop=True)
+        return resampled_per_time_frame